@@ -14,14 +14,17 @@
 # retrywait='An integer' \
 # required='A boolean' \
 # --base-url URL \
-# --output PATH
+# --output PATH \
+# --compress
 
 #
 # --item can be used unlimited times
 # If you do do not specify an item-url, one will be generated as
 # base-url/stage/file-name-of-item
 # Future plan for this tool is to add AWS S3 integration for auto-upload
+# --compress also writes bootstrap.json.gz next to bootstrap.json
 
+import gzip
 import hashlib
 import json
 import argparse
@@ -187,6 +190,11 @@ def build_item_dict(itemsToProcess, base_url):
         # Determine the hash of the item to process - SHA256
         itemJson['hash'] = gethash(filePath)
 
+        # Record the size so a download of the wrong thing (a captive portal
+        # page, say) can be stopped as soon as the server responds
+        if os.path.isfile(filePath):
+            itemJson['size'] = os.path.getsize(filePath)
+
         # Add information for scripts and packages
         if itemType in ('rootscript', 'userscript'):
             if itemType == 'userscript':
@@ -271,6 +279,9 @@ def main():
                         help='Required: Options for item. All items are \
                         required. Scripts default to rootscript and stage \
                         Scripts default to rootscript and stage defaults to userland')
+    parser.add_argument('--compress', default=False, action='store_true',
+                        help='Optional: Also save a gzip compressed copy of \
+                        the json as bootstrap.json.gz')
     args = parser.parse_args()
 
     # Bail if we don't have one item, the base url and the output dir
@@ -305,6 +316,14 @@ def main():
 
     print('Json saved to %s' % savePath)
 
+    if args.compress:
+        # mtime=0 keeps the compressed file identical between runs when the
+        # json hasn't changed, so it doesn't look new to caching servers
+        with open(savePath, 'rb') as inFile:
+            with gzip.GzipFile(savePath + '.gz', 'wb', mtime=0) as outFile:
+                outFile.write(inFile.read())
+        print('Compressed json saved to %s.gz' % savePath)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,326 @@
+# encoding: utf-8
+#
+# Copyright 2017-Present Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+downloadutils.py
+
+Helpers for managing downloaded files that don't depend on PyObjC, so they
+can be shared by the download code and exercised on any platform.
+"""
+import os
+import plistlib
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import xattr
+except ImportError:
+    xattr = None
+
+
+# Same attribute name munki uses, so existing partial downloads still resume
+METADATA_XATTR = 'com.googlecode.munki.downloadData'
+# Used when the filesystem (or platform) doesn't support extended attributes
+SIDECAR_SUFFIX = '.downloadData'
+# Error code for a response that isn't the size the manifest says the file
+# is. Same value as NSURLErrorDataLengthExceedsMaximum.
+SIZE_MISMATCH_ERROR = -1103
+# fcntl commands and flags for preallocating space on macOS
+F_PREALLOCATE = 42
+F_ALLOCATEALL = 0x4
+F_PEOFPOSMODE = 3
+
+
+def sidecar_path(path):
+    '''Returns the path of the metadata sidecar file for path'''
+    return path + SIDECAR_SUFFIX
+
+
+def get_stored_headers(path):
+    '''Returns the download metadata (etag, last-modified, expected-length)
+    stored for path, or an empty dict if there is none'''
+    data = None
+    if xattr is not None:
+        try:
+            data = xattr.getxattr(path, METADATA_XATTR)
+        except (KeyError, OSError):
+            data = None
+    if data is None:
+        try:
+            with open(sidecar_path(path), 'rb') as sidecar:
+                data = sidecar.read()
+        except OSError:
+            return {}
+    try:
+        return plistlib.loads(data)
+    except Exception:
+        return {}
+
+
+def store_headers(path, headers):
+    '''Stores download metadata for path as an extended attribute, falling
+    back to a sidecar file. Returns False if neither could be written.'''
+    data = plistlib.dumps(dict(headers))
+    if xattr is not None:
+        try:
+            xattr.setxattr(path, METADATA_XATTR, data)
+        except OSError:
+            pass
+        else:
+            # don't leave a stale sidecar from an earlier fallback around
+            if os.path.exists(sidecar_path(path)):
+                os.unlink(sidecar_path(path))
+            return True
+    try:
+        with open(sidecar_path(path), 'wb') as sidecar:
+            sidecar.write(data)
+    except OSError:
+        return False
+    return True
+
+
+def remove_stored_headers(path):
+    '''Removes any download metadata stored for path'''
+    if xattr is not None:
+        try:
+            xattr.removexattr(path, METADATA_XATTR)
+        except (KeyError, OSError):
+            pass
+    try:
+        os.unlink(sidecar_path(path))
+    except OSError:
+        pass
+
+
+def replace_file(source, destination):
+    '''Atomically moves source over destination, along with any download
+    metadata stored in a sidecar file'''
+    os.rename(source, destination)
+    if os.path.exists(sidecar_path(source)):
+        os.rename(sidecar_path(source), sidecar_path(destination))
+    elif os.path.exists(sidecar_path(destination)):
+        # metadata moved with the file as an xattr; drop the stale sidecar
+        os.unlink(sidecar_path(destination))
+
+
+def clone_file(source, destination):
+    '''Copies source to destination, as an APFS clone where possible so the
+    copy is instant and doesn't take up extra space'''
+    if sys.platform == 'darwin':
+        if subprocess.call(['/bin/cp', '-c', source, destination],
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL) == 0:
+            return
+    shutil.copyfile(source, destination)
+
+
+def preallocate(fileref, length):
+    '''Asks the filesystem to reserve length more bytes past the end of
+    fileref, so a large download is laid out contiguously and a full disk
+    is noticed up front. The file's size doesn't change, so a partial
+    download can still be resumed from it. Only supported on macOS.'''
+    if sys.platform != 'darwin' or length <= 0:
+        return
+    import fcntl
+    # struct fstore_t: flags, posmode, offset, length, bytesalloc
+    fstore = struct.pack('IiqqQ', F_ALLOCATEALL, F_PEOFPOSMODE, 0, length, 0)
+    try:
+        fcntl.fcntl(fileref.fileno(), F_PREALLOCATE, fstore)
+    except (IOError, OSError):
+        pass
+
+
+def size_mismatch(expected_size, status, normalized_headers, decompress=False):
+    '''Returns a message if the headers of a response show it isn't the file
+    of expected_size (e.g. a captive portal page), otherwise None. When the
+    body is decompressed as it is written, expected_size is the decompressed
+    size and can only be checked against what is written.'''
+    if not expected_size or not str(status).startswith('2') or decompress:
+        return None
+    if 'content-encoding' in normalized_headers:
+        # Content-Length is the size of the encoded body
+        return None
+    if status == 206:
+        declared = str(normalized_headers.get('content-range', ''))
+        declared = declared.rpartition('/')[2].strip()
+    else:
+        declared = str(normalized_headers.get('content-length', '')).strip()
+    if not declared.isdigit() or int(declared) == expected_size:
+        return None
+    return ('Server is sending %s bytes, but %s were expected'
+            % (declared, expected_size))
+
+
+def link_or_clone(source, destination):
+    '''Hardlinks source to destination, or clones it if that fails (for
+    example when they are on different volumes)'''
+    try:
+        os.link(source, destination)
+    except OSError:
+        clone_file(source, destination)
+
+
+def unshare(path):
+    '''Removes path if it is hardlinked elsewhere, so writing a new
+    download to it can't modify the other copies'''
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.unlink(path)
+    except OSError:
+        pass
+
+
+class ProgressReporter(object):
+    '''Calls callback(connection) as a download progresses, at most once
+    every `interval` seconds and only after at least `min_bytes` more bytes
+    have arrived'''
+
+    def __init__(self, callback, interval=1.0, min_bytes=0):
+        self.callback = callback
+        self.interval = interval
+        self.min_bytes = min_bytes
+        self.last_time = 0
+        self.last_bytes = 0
+
+    def update(self, connection):
+        '''Called each time data is received'''
+        if not self.callback:
+            return
+        now = time.time()
+        if (now - self.last_time < self.interval or
+                connection.bytesReceived - self.last_bytes < self.min_bytes):
+            return
+        self.last_time = now
+        self.last_bytes = connection.bytesReceived
+        self.callback(connection)
+
+
+class DestinationWriter(object):
+    '''Collects received data into large writes to a download's destination
+    file, instead of writing each small chunk as it arrives. The file is
+    fsynced every sync_interval bytes (0 for never), so a partial download
+    that is resumed after a crash or power loss only holds data that made it
+    to disk. Counts writes and the time spent in them to measure write
+    throughput.'''
+
+    def __init__(self, fileref, buffer_size=2 ** 20, sync_interval=2 ** 26,
+                 preallocate_size=0):
+        self.fileref = fileref
+        self.buffer_size = buffer_size
+        self.sync_interval = sync_interval
+        self.buffer = bytearray()
+        self.unsynced = 0
+        self.bytesWritten = 0
+        self.writeCount = 0
+        self.syncCount = 0
+        self.writeTime = 0.0
+        if preallocate_size > 0:
+            preallocate(fileref, preallocate_size)
+
+    def write(self, data):
+        '''Adds data to the buffer, writing it out once it is full'''
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        '''Writes out the buffer, and fsyncs at checkpoints'''
+        if not self.buffer:
+            return
+        started = time.time()
+        self.fileref.write(self.buffer)
+        self.fileref.flush()
+        self.writeCount += 1
+        self.bytesWritten += len(self.buffer)
+        self.unsynced += len(self.buffer)
+        self.buffer = bytearray()
+        if self.sync_interval and self.unsynced >= self.sync_interval:
+            os.fsync(self.fileref.fileno())
+            self.syncCount += 1
+            self.unsynced = 0
+        self.writeTime += time.time() - started
+
+    def close(self):
+        '''Writes out anything buffered and closes the file'''
+        try:
+            self.flush()
+        finally:
+            self.fileref.close()
+
+
+class GzipDecoder(object):
+    '''Decompresses a gzip stream incrementally as it is received'''
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decode(self, data):
+        '''Returns the decompressed bytes available from data'''
+        output = self.decompressor.decompress(data)
+        # A gzip file may be several members back to back
+        while self.decompressor.eof and self.decompressor.unused_data:
+            data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            output += self.decompressor.decompress(data)
+        return output
+
+    def flush(self):
+        '''Returns any remaining decompressed bytes at the end of the
+        stream'''
+        return self.decompressor.flush()
+
+
+class TokenBucket(object):
+    '''Limits the bytes received by every download it is passed to, to
+    `rate` bytes per second on average with bursts of up to `burst` bytes.
+    A rate of 0 means unlimited. The rate can be changed while downloads
+    are running.'''
+
+    def __init__(self, rate, burst=None):
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        '''Changes the limit. Burst defaults to a second's worth of data.'''
+        with self.lock:
+            self.rate = rate
+            self.burst = burst or max(rate, 2 ** 16)
+            self.tokens = min(self.tokens, self.burst)
+
+    def consume(self, count):
+        '''Accounts for count bytes that were just received, sleeping for
+        as long as it takes the bucket to pay them back. Callers block in
+        the network read path, so the sender is slowed down by TCP flow
+        control rather than by buffering.'''
+        with self.lock:
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Going into debt lets concurrent downloads queue up behind each
+            # other without any of them being starved.
+            self.tokens -= count
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
@@ -29,8 +29,11 @@ signatures.
 """
 from __future__ import absolute_import, print_function
 
+import hashlib
 import os
-import xattr
+import threading
+
+import downloadutils
 
 try:
     # Python 2
@@ -50,16 +53,13 @@ from objc import super
 # pylint: disable=E0611
 
 
-from Foundation import (NSBundle, NSRunLoop, NSData, NSDate,
+from Foundation import (NSBundle, NSRunLoop, NSDate,
                         NSObject, NSURL, NSURLConnection,
                         NSMutableURLRequest,
                         NSURLRequestReloadIgnoringLocalCacheData,
                         NSURLResponseUnknownLength,
-                        NSLog,
-                        NSURLCredential, NSURLCredentialPersistenceNone,
-                        NSPropertyListSerialization,
-                        NSPropertyListMutableContainersAndLeaves,
-                        NSPropertyListXMLFormat_v1_0)
+                        NSError, NSLog,
+                        NSURLCredential, NSURLCredentialPersistenceNone)
 
 try:
     from Foundation import NSURLSession, NSURLSessionConfiguration
@@ -191,7 +191,7 @@ class Gurl(NSObject):
     # initWithOptions_(), so:
     # pylint: disable=E1101,W0201
 
-    GURL_XATTR = 'com.googlecode.munki.downloadData'
+    GURL_XATTR = downloadutils.METADATA_XATTR
 
     def initWithOptions_(self, options):
         '''Set up our Gurl object'''
@@ -203,6 +203,7 @@ class Gurl(NSObject):
         self.ignore_system_proxy = options.get('ignore_system_proxy', False)
         self.destination_path = options.get('file')
         self.can_resume = options.get('can_resume', False)
+        self.byte_range = options.get('byte_range')
         self.url = options.get('url')
         self.additional_headers = options.get('additional_headers', {})
         self.username = options.get('username')
@@ -211,11 +212,24 @@ class Gurl(NSObject):
             'download_only_if_changed', False)
         self.cache_data = options.get('cache_data')
         self.connection_timeout = options.get('connection_timeout', 60)
+        self.hash_algorithm = options.get('hash_algorithm', 'sha256')
+        # downloadutils.TokenBucket instances to throttle received data with
+        self.rate_limiters = options.get('rate_limiters', [])
+        # the body is a .gz artifact to be stored decompressed
+        self.decompress = options.get('decompress', False)
+        # size of the complete file, from the manifest
+        self.expected_size = options.get('expected_size')
+        self.write_buffer_size = options.get('write_buffer_size', 2 ** 20)
+        self.sync_interval = options.get('sync_interval', 2 ** 26)
         if NSURLSESSION_AVAILABLE:
             self.minimum_tls_protocol = options.get(
                 'minimum_tls_protocol', kTLSProtocol1)
 
         self.log = options.get('logging_function', NSLogWrapper)
+        self.progress = downloadutils.ProgressReporter(
+            options.get('progress_callback'),
+            options.get('progress_interval', 1.0),
+            options.get('progress_bytes', 0))
 
         self.resume = False
         self.response = None
@@ -224,11 +238,20 @@ class Gurl(NSObject):
         self.error = None
         self.SSLerror = None
         self.done = False
+        self.aborted = False
+        self.done_event = threading.Event()
         self.redirection = []
         self.destination = None
         self.bytesReceived = 0
+        self.bytesWritten = 0
+        self.writeCount = 0
+        self.writeTime = 0.0
+        self.syncCount = 0
         self.expectedLength = -1
         self.percentComplete = 0
+        self.hash_function = None
+        self.digest = None
+        self.decoder = None
         self.connection = None
         self.session = None
         self.task = None
@@ -238,7 +261,7 @@ class Gurl(NSObject):
         '''Start the connection'''
         if not self.destination_path:
             self.log('No output file specified.')
-            self.done = True
+            self.markDone()
             return
         url = NSURL.URLWithString_(self.url)
         request = (
@@ -248,8 +271,12 @@ class Gurl(NSObject):
         if self.additional_headers:
             for header, value in self.additional_headers.items():
                 request.setValue_forHTTPHeaderField_(value, header)
+        if self.byte_range:
+            # fetching one segment of a file; written in place at its offset
+            request.setValue_forHTTPHeaderField_(
+                'bytes=%s-%s' % tuple(self.byte_range), 'Range')
         # does the file already exist? See if we can resume a partial download
-        if os.path.isfile(self.destination_path):
+        elif os.path.isfile(self.destination_path):
             stored_data = self.getStoredHeaders()
             if (self.can_resume and 'expected-length' in stored_data and
                     ('last-modified' in stored_data or 'etag' in stored_data)):
@@ -291,12 +318,34 @@ class Gurl(NSObject):
 
     def cancel(self):
         '''Cancel the connection'''
-        if self.connection:
-            if NSURLSESSION_AVAILABLE:
-                self.session.invalidateAndCancel()
-            else:
-                self.connection.cancel()
-            self.done = True
+        if self.session:
+            self.session.invalidateAndCancel()
+            self.markDone()
+        elif self.connection:
+            self.connection.cancel()
+            self.markDone()
+
+    def markDone(self):
+        '''Flag the connection as complete and wake up anyone waiting'''
+        self.done = True
+        self.done_event.set()
+
+    def wait(self, timeout=None):
+        '''Block until the connection request is complete or timeout
+        seconds have passed. Returns True if it is complete.'''
+        if NSURLSESSION_AVAILABLE:
+            # session delegate methods run on their own queue, so there is
+            # no need to pump the run loop here
+            self.done_event.wait(timeout)
+            return self.done
+        # NSURLConnection delivers delegate methods on this thread's run loop
+        deadline = None
+        if timeout is not None:
+            deadline = NSDate.dateWithTimeIntervalSinceNow_(timeout)
+        while not self.isDone():
+            if deadline is not None and deadline.timeIntervalSinceNow() <= 0:
+                break
+        return self.done
 
     def isDone(self):
         '''Check if the connection request is complete. As a side effect,
@@ -310,40 +359,13 @@ class Gurl(NSObject):
 
     def getStoredHeaders(self):
         '''Returns any stored headers for self.destination_path'''
-        # try to read stored headers
-        try:
-            stored_plist_bytestr = xattr.getxattr(
-                self.destination_path, self.GURL_XATTR)
-        except (KeyError, IOError):
-            return {}
-        data = NSData.dataWithBytes_length_(
-            stored_plist_bytestr, len(stored_plist_bytestr))
-        dataObject, _plistFormat, error = (
-            NSPropertyListSerialization.
-            propertyListFromData_mutabilityOption_format_errorDescription_(
-                data, NSPropertyListMutableContainersAndLeaves, None, None))
-        if error:
-            return {}
-        return dataObject
+        return downloadutils.get_stored_headers(self.destination_path)
 
     def storeHeaders_(self, headers):
-        '''Store dictionary data as an xattr for self.destination_path'''
-        plistData, error = (
-            NSPropertyListSerialization.
-            dataFromPropertyList_format_errorDescription_(
-                headers, NSPropertyListXMLFormat_v1_0, None))
-        if error:
-            byte_string = b''
-        else:
-            try:
-                byte_string = bytes(plistData)
-            except NameError:
-                byte_string = str(plistData)
-        try:
-            xattr.setxattr(self.destination_path, self.GURL_XATTR, byte_string)
-        except IOError as err:
-            self.log('Could not store metadata to %s: %s'
-                     % (self.destination_path, err))
+        '''Store dictionary data as an xattr for self.destination_path, or
+        in a sidecar file where xattrs aren't available'''
+        if not downloadutils.store_headers(self.destination_path, headers):
+            self.log('Could not store metadata to %s' % self.destination_path)
 
     def normalizeHeaderDict_(self, a_dict):
         '''Since HTTP header names are not case-sensitive, we normalize a
@@ -360,6 +382,9 @@ class Gurl(NSObject):
 
     def recordError_(self, error):
         '''Record any error info from completed connection/session'''
+        if self.aborted:
+            # keep the reason we aborted, not the cancellation it caused
+            return
         self.error = error
         # If this was an SSL error, try to extract the SSL error code.
         if 'NSUnderlyingError' in error.userInfo():
@@ -369,6 +394,67 @@ class Gurl(NSObject):
                 self.SSLerror = (ssl_code, ssl_error_codes.get(
                     ssl_code, 'Unknown SSL error'))
 
+    def startDigest_(self, seed_path):
+        '''Start hashing the destination file as it is written so callers
+        don't need to re-read it to verify it. When resuming, seed_path is
+        the partial file already on disk.'''
+        if not self.hash_algorithm:
+            return
+        self.hash_function = hashlib.new(self.hash_algorithm)
+        if seed_path:
+            with open(seed_path, 'rb') as fileref:
+                while True:
+                    chunk = fileref.read(2 ** 16)
+                    if not chunk:
+                        break
+                    self.hash_function.update(chunk)
+
+    def closeDestination(self):
+        '''Close the destination file and record the digest of what was
+        written to it'''
+        if self.decoder is not None:
+            self.writeData_(self.decoder.flush())
+            self.decoder = None
+        self.destination.close()
+        self.writeCount = self.destination.writeCount
+        self.writeTime = self.destination.writeTime
+        self.syncCount = self.destination.syncCount
+        if self.hash_function is not None:
+            self.digest = self.hash_function.hexdigest()
+
+    def openDestination_preallocate_(self, fileref, size):
+        '''Wrap fileref so received data is written in large blocks'''
+        self.destination = downloadutils.DestinationWriter(
+            fileref, self.write_buffer_size, self.sync_interval, size)
+
+    def fileSize(self):
+        '''The size the destination will end up, if it is known'''
+        if self.expected_size:
+            return self.expected_size
+        if (self.decoder is None and
+                self.expectedLength != NSURLResponseUnknownLength):
+            return self.expectedLength
+        return 0
+
+    def abortWithMessage_(self, message):
+        '''Stop the transfer because the server isn't sending the file we
+        expect (e.g. a captive portal page), and throw away what we got'''
+        self.log(message)
+        self.aborted = True
+        self.error = NSError.errorWithDomain_code_userInfo_(
+            'NSURLErrorDomain', downloadutils.SIZE_MISMATCH_ERROR,
+            {'NSLocalizedDescription': message})
+        if self.destination:
+            self.closeDestination()
+            self.destination = None
+            os.unlink(self.destination_path)
+            downloadutils.remove_stored_headers(self.destination_path)
+        if self.task:
+            self.task.cancel()
+        elif self.connection:
+            self.connection.cancel()
+            self.markDone()
+
     def removeExpectedSizeFromStoredHeaders(self):
         '''If a successful transfer, clear the expected size so we
         don\'t attempt to resume the download next time'''
@@ -381,28 +467,38 @@ class Gurl(NSObject):
 
     def URLSession_task_didCompleteWithError_(self, _session, _task, error):
         '''NSURLSessionTaskDelegate method.'''
+        if _task is not self.task:
+            # a task we cancelled and replaced when restarting the download
+            return
         if self.destination and self.destination_path:
-            self.destination.close()
-            self.removeExpectedSizeFromStoredHeaders()
+            self.closeDestination()
+            if not error:
+                # keep the expected size around after a failed transfer so
+                # the next attempt can resume it
+                self.removeExpectedSizeFromStoredHeaders()
         if error:
             self.recordError_(error)
-        self.done = True
+        self.markDone()
 
     def connection_didFailWithError_(self, _connection, error):
         '''NSURLConnectionDelegate method
         Sent when a connection fails to load its request successfully.'''
+        if _connection is not self.connection:
+            return
         self.recordError_(error)
-        self.done = True
         if self.destination and self.destination_path:
-            self.destination.close()
+            self.closeDestination()
+        self.markDone()
 
     def connectionDidFinishLoading_(self, _connection):
         '''NSURLConnectionDataDelegate method
         Sent when a connection has finished loading successfully.'''
-        self.done = True
+        if _connection is not self.connection:
+            return
         if self.destination and self.destination_path:
-            self.destination.close()
+            self.closeDestination()
             self.removeExpectedSizeFromStoredHeaders()
+        self.markDone()
 
     def handleResponse_withCompletionHandler_(
             self, response, completionHandler):
@@ -423,13 +519,35 @@ class Gurl(NSObject):
                     'last-modified']
             if 'etag' in normalized_headers:
                 download_data['etag'] = normalized_headers['etag']
-            download_data['expected-length'] = self.expectedLength
+            # NSURLSession decodes Content-Encoding itself, so the bytes on
+            # disk can't be matched up with a range of the encoded body to
+            # resume from
+            if 'content-encoding' not in normalized_headers:
+                download_data['expected-length'] = self.expectedLength
+            mismatch = downloadutils.size_mismatch(
+                self.expected_size, self.status, normalized_headers,
+                self.decompress)
+            if mismatch:
+                self.abortWithMessage_(mismatch)
+                if completionHandler:
+                    completionHandler(NSURLSessionResponseCancel)
+                return
 
         # self.destination is defined in initWithOptions_
         # pylint: disable=E0203
 
         if not self.destination and self.destination_path:
-            if self.status == 206 and self.resume:
+            if self.status == 206 and self.byte_range:
+                # write this segment in place; the caller has already
+                # preallocated the file and verifies the hash once all
+                # segments are done
+                if not os.path.exists(self.destination_path):
+                    open(self.destination_path, 'wb').close()
+                fileref = open(self.destination_path, 'r+b')
+                fileref.seek(self.byte_range[0])
+                self.openDestination_preallocate_(fileref, 0)
+
+            elif self.status == 206 and self.resume:
                 # 206 is Partial Content response
                 stored_data = self.getStoredHeaders()
                 if (not stored_data or
@@ -441,17 +559,21 @@ class Gurl(NSObject):
                     self.log(
                         'Can\'t resume download; file on server has changed.')
                     if completionHandler:
-                        # tell the session task to cancel
+                        # tell the session task to cancel, and let the
+                        # session go once it has
                         completionHandler(NSURLSessionResponseCancel)
+                        self.session.finishTasksAndInvalidate()
                     else:
                         # cancel the connection
                         self.connection.cancel()
                     self.log('Removing %s' % self.destination_path)
                     os.unlink(self.destination_path)
-                    # restart and attempt to download the entire file
+                    # restart and attempt to download the entire file. The
+                    # callbacks check self.task/self.connection, so anything
+                    # still arriving for the old request is ignored.
+                    self.resume = False
                     self.log(
                         'Restarting download of %s' % self.destination_path)
-                    os.unlink(self.destination_path)
                     self.start()
                     return
                 # try to resume
@@ -459,13 +581,33 @@ class Gurl(NSObject):
                 # add existing file size to bytesReceived so far
                 local_filesize = os.path.getsize(self.destination_path)
                 self.bytesReceived = local_filesize
+                self.bytesWritten = local_filesize
                 self.expectedLength += local_filesize
-                # open file for append
-                self.destination = open(self.destination_path, 'ab')
+                # hash what we already have, then open file for append
+                self.startDigest_(self.destination_path)
+                self.openDestination_preallocate_(
+                    open(self.destination_path, 'ab'),
+                    self.fileSize() - local_filesize)
+
+            elif self.status == 416 and self.resume:
+                # 416 is Range Not Satisfiable: what we have on disk can't
+                # be a prefix of the file on the server. Throw it away so the
+                # next attempt starts from scratch.
+                self.log('Can\'t resume download; removing %s'
+                         % self.destination_path)
+                os.unlink(self.destination_path)
+                downloadutils.remove_stored_headers(self.destination_path)
 
             elif str(self.status).startswith('2'):
                 # not resuming, just open the file for writing
-                self.destination = open(self.destination_path, 'wb')
+                fileref = open(self.destination_path, 'wb')
+                self.startDigest_(None)
+                # NSURLSession has already gunzipped a body sent with
+                # Content-Encoding, so only decode it ourselves otherwise
+                if (self.decompress and
+                        'content-encoding' not in normalized_headers):
+                    self.decoder = downloadutils.GzipDecoder()
+                self.openDestination_preallocate_(fileref, self.fileSize())
                 # store some headers with the file for use if we need to resume
                 # the download and for future checking if the file on the server
                 # has changed
@@ -480,12 +622,17 @@ class Gurl(NSObject):
         '''NSURLSessionDataDelegate method'''
         if CALLBACK_HELPER_AVAILABLE:
             completionHandler.__block_signature__ = objc_method_signature(b'v@i')
+        if _task is not self.task:
+            completionHandler(NSURLSessionResponseCancel)
+            return
         self.handleResponse_withCompletionHandler_(response, completionHandler)
 
     def connection_didReceiveResponse_(self, _connection, response):
         '''NSURLConnectionDataDelegate delegate method
         Sent when the connection has received sufficient data to construct the
         URL response for its request.'''
+        if _connection is not self.connection:
+            return
         self.handleResponse_withCompletionHandler_(response, None)
 
     def handleRedirect_newRequest_withCompletionHandler_(
@@ -673,10 +820,30 @@ class Gurl(NSObject):
         self.log('connection_didReceiveAuthenticationChallenge_')
         self.handleChallenge_withCompletionHandler_(challenge, None)
 
+    def writeData_(self, data):
+        '''Write data to the destination and add it to the digest'''
+        self.destination.write(data)
+        self.bytesWritten += len(data)
+        if self.hash_function is not None:
+            self.hash_function.update(data)
+
     def handleReceivedData_(self, data):
         '''Handle received data'''
+        if self.aborted:
+            # data already in flight when the transfer was cancelled
+            return
+        for limiter in self.rate_limiters:
+            limiter.consume(len(data))
         if self.destination:
-            self.destination.write(data)
+            if self.decoder is not None:
+                self.writeData_(self.decoder.decode(bytes(data)))
+            else:
+                self.writeData_(data)
+            if (self.expected_size and not self.byte_range and
+                    self.bytesWritten > self.expected_size):
+                self.abortWithMessage_('Received more than the expected %s '
+                                       'bytes' % self.expected_size)
+                return
         else:
             try:
                 self.log(str(data))
@@ -688,14 +855,19 @@ class Gurl(NSObject):
             self.percentComplete = int(
                 float(self.bytesReceived)/float(self.expectedLength) * 100.0)
             # pylint: enable=old-division
+        self.progress.update(self)
 
     def URLSession_dataTask_didReceiveData_(self, _session, _task, data):
         '''NSURLSessionDataDelegate method'''
+        if _task is not self.task:
+            return
         self.handleReceivedData_(data)
 
     def connection_didReceiveData_(self, _connection, data):
         '''NSURLConnectionDataDelegate method
         Sent as a connection loads data incrementally'''
+        if _connection is not self.connection:
+            return
         self.handleReceivedData_(data)
 
 
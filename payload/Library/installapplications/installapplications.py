@@ -27,24 +27,61 @@
 
 from Foundation import NSLog
 from SystemConfiguration import SCDynamicStoreCopyConsoleUser
+import collections
+import copy
+import email.utils
+import functools
+import glob
 import hashlib
+import heapq
 import json
 import optparse
 import os
 import plistlib
+import queue
+import random
 import re
+import select
 import shutil
+import signal
+import socket
+import ssl
+import struct
 import subprocess
 import sys
+import threading
 import time
 import urllib.request, urllib.parse, urllib.error
 
 sys.path.append("/Library/installapplications")
 # PEP8 can really be annoying at times.
+import downloadutils  # noqa
 import gurl  # noqa
+import poolurl  # noqa
 
 
 g_dry_run = False
+g_hash_cache = None
+g_transport = "gurl"
+g_package_store = None
+g_middleware = None
+g_retry_policy = None
+g_pace_until = 0
+g_pace_lock = threading.Lock()
+g_max_retry_after = 900
+g_rate_limiter = None
+g_rate_limit = 0
+g_item_limiters = {}
+g_item_limiters_lock = threading.Lock()
+g_throttle_config = None
+g_throttle_mtime = None
+g_mirror_ranker = None
+g_seed_index = None
+g_receipts = None
+g_supervisor = None
+g_userscripts = None
+g_install_lock = threading.Lock()
+g_runtimes_lock = threading.Lock()
 
 
 def _cmp(x, y):
@@ -208,57 +245,428 @@ def pkgregex(pkgpath):
         return pkgpath
 
 
-def installpackage(packagepath):
+class ProcessSupervisor(object):
+    """Keeps track of every process the run starts. Each one gets its own
+    process group, so a process with a timeout can be stopped along with
+    anything it spawned: the group is sent SIGTERM once it runs past it,
+    then SIGKILL GRACE seconds later. donotwait processes are waited on in
+    the background so they are reaped, and report() describes how each
+    process ended."""
+
+    GRACE = 10
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def start(self, name, cmd, timeout=None, donotwait=False, **kwargs):
+        proc = subprocess.Popen(cmd, start_new_session=True, **kwargs)
+        record = {
+            "name": name,
+            "proc": proc,
+            "start": time.time(),
+            "timeout": timeout,
+            "donotwait": donotwait,
+            "timed_out": False,
+        }
+        with self.lock:
+            self.records.append(record)
+        if donotwait:
+            waiter = threading.Thread(target=self.wait, args=(proc,))
+            waiter.daemon = True
+            waiter.start()
+        return proc
+
+    def wait(self, proc):
+        """Waits for proc to exit, enforcing its timeout. Returns the exit
+        code, which is negative if it had to be stopped."""
+        with self.lock:
+            record = [r for r in self.records if r["proc"] is proc][0]
+        timeout = record["timeout"]
+        try:
+            proc.wait(timeout=timeout or None)
+        except subprocess.TimeoutExpired:
+            iaslog("%s still running after %s seconds, terminating"
+                   % (record["name"], timeout))
+            record["timed_out"] = True
+            self._signal(proc, signal.SIGTERM)
+            try:
+                proc.wait(timeout=self.GRACE)
+            except subprocess.TimeoutExpired:
+                iaslog("%s did not exit, killing" % record["name"])
+            # Also takes out children that outlived the process itself
+            self._signal(proc, signal.SIGKILL)
+            proc.wait()
+        record["end"] = time.time()
+        return proc.returncode
+
+    def _signal(self, proc, signum):
+        try:
+            os.killpg(proc.pid, signum)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def report(self):
+        """Returns a dictionary describing every process started so far,
+        keyed by name"""
+        now = time.time()
+        report = {}
+        with self.lock:
+            records = list(self.records)
+        for record in records:
+            entry = {
+                "pid": record["proc"].pid,
+                "donotwait": record["donotwait"],
+                "timed_out": record["timed_out"],
+                "runtime": round(record.get("end", now) - record["start"], 2),
+            }
+            if "end" in record:
+                entry["exit_code"] = record["proc"].returncode
+            else:
+                entry["running"] = True
+            name = record["name"]
+            if name in report:
+                name = "%s (%d)" % (name, entry["pid"])
+            report[name] = entry
+        return report
+
+
+def record_processes():
+    """Notes how every process the run started ended in
+    ia_item_runtimes.plist"""
+    if g_supervisor is None:
+        return
+    try:
+        with g_runtimes_lock:
+            ias_item_runtimes_dict["processes"] = g_supervisor.report()
+            with open(ias_item_runtimes_plist, "wb") as ias_runtimes_file:
+                plistlib.dump(ias_item_runtimes_dict, ias_runtimes_file)
+    except (NameError, OSError) as err:
+        iaslog("Could not record processes: %s" % err)
+
+
+OUTPUT_TAIL_LINES = 50
+
+
+def _pump_output(stream, tail, on_line):
+    for raw in iter(stream.readline, b""):
+        line = raw.decode("utf-8", "replace").rstrip("\r\n")
+        if not line:
+            continue
+        try:
+            if on_line is not None and on_line(line):
+                continue
+        except Exception as err:
+            # Keep draining the pipe or the process blocks once it fills
+            iaslog("Error handling output line: %s" % err)
+        tail.append(line)
+        # Replace any instances of % with a space and any elipsis with
+        # a blank line since NSLog can't handle these kinds of characters.
+        # Hopefully this is the only bad characters we will ever run into.
+        iaslog(line.replace("%", " ").replace("\u2026", ""))
+    stream.close()
+
+
+def stream_process(cmd, on_line=None, name=None, timeout=None, **kwargs):
+    """Runs cmd, logging stdout and stderr line by line as they are produced
+    rather than after it exits. on_line is called with each line first and
+    can return True to keep it out of the log and the tail. The process is
+    stopped if it runs longer than timeout seconds. Returns the exit code
+    and the last OUTPUT_TAIL_LINES lines of stdout and stderr, for error
+    reporting."""
+    supervisor = g_supervisor or ProcessSupervisor()
+    if name is None:
+        name = cmd if isinstance(cmd, str) else cmd[0]
+    proc = supervisor.start(
+        name, cmd, timeout, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        **kwargs
+    )
+    tails = (
+        collections.deque(maxlen=OUTPUT_TAIL_LINES),
+        collections.deque(maxlen=OUTPUT_TAIL_LINES),
+    )
+    readers = [
+        threading.Thread(target=_pump_output, args=(stream, tail, on_line))
+        for stream, tail in zip((proc.stdout, proc.stderr), tails)
+    ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    rcode = supervisor.wait(proc)
+    # A child the process left behind may still hold the pipes open
+    deadline = time.time() + 5
+    for reader in readers:
+        reader.join(max(0, deadline - time.time()))
+    return rcode, list(tails[0]), list(tails[1])
+
+
+def log_output_tail(label, lines):
+    if lines:
+        iaslog("Last %d lines on %s:" % (len(lines), label))
+        for line in lines:
+            iaslog(line.replace("%", " ").replace("\u2026", ""))
+
+
+class InstallerProgress(object):
+    """Turns installer -verboseR progress lines (installer:%42.5) into
+    calls to callback(percent, phase), where phase is the last
+    installer:PHASE: message. Progress is logged every `step` percent
+    instead of on every line, and callback only hears about whole percent
+    steps."""
+
+    PROGRESS = re.compile(r"^installer:%(\d+(?:\.\d+)?)")
+
+    def __init__(self, name, callback=None, step=10):
+        self.name = name
+        self.callback = callback
+        self.step = step
+        self.next_log = step
+        self.phase = None
+        self.reported = None
+
+    def __call__(self, line):
+        if line.startswith("installer:PHASE:"):
+            self.phase = line[len("installer:PHASE:"):]
+            return False
+        match = self.PROGRESS.match(line)
+        if not match:
+            return False
+        percent = float(match.group(1))
+        if percent >= self.next_log:
+            iaslog("Installing %s: %d percent" % (self.name, percent))
+            self.next_log = (int(percent) // self.step + 1) * self.step
+        if self.callback is not None and (int(percent), self.phase) != self.reported:
+            self.reported = (int(percent), self.phase)
+            try:
+                self.callback(percent, self.phase)
+            except Exception as err:
+                iaslog("Progress callback for %s failed: %s" % (self.name, err))
+        return True
+
+
+def installpackage(packagepath, progress_callback=None, timeout=None, name=None):
     try:
         cmd = ["/usr/sbin/installer", "-verboseR", "-pkg", packagepath, "-target", "/"]
         if g_dry_run:
             iaslog("Dry run installing package: %s" % packagepath)
             return 0
-        proc = subprocess.Popen(
+        name = name or pkgregex(packagepath)
+        rcode, out, err = stream_process(
             cmd,
-            shell=False,
-            bufsize=-1,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            on_line=InstallerProgress(name, progress_callback),
+            name=name,
+            timeout=timeout,
+            stdin=subprocess.DEVNULL,
         )
-        output, rcode = proc.communicate(), proc.returncode
-        installlog = output[0].split("\n")
-        # Filter all blank lines after the split.
-        for line in [_f for _f in installlog if _f]:
-            # Replace any instances of % with a space and any elipsis with
-            # a blank line since NSLog can't handle these kinds of characters.
-            # Hopefully this is the only bad characters we will ever run into.
-            logline = line.replace("%", " ").replace("\xe2\x80\xa6", "")
-            iaslog(logline)
+        if rcode != 0:
+            iaslog("installer exited with %d for %s" % (rcode, packagepath))
+            log_output_tail("stderr", err or out)
         return rcode
-    except Exception:
-        pass
+    except Exception as err:
+        iaslog("Failure running installer: %s" % err)
+
+
+NOT_INSTALLED = "0.0.0.0.0"
+RECEIPTS_PATHS = ["/var/db/receipts", "/Library/Apple/System/Library/Receipts"]
+
+
+class DirectoryReceiptSource(object):
+    """Reads package receipts straight from the receipts database, one
+    <packageid>.plist per installed package."""
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def receipts(self):
+        """Returns {packageid: version} for every receipt, or None if none of
+        the directories could be read."""
+        found = False
+        receipts = {}
+        for path in self.paths:
+            if not os.path.isdir(path):
+                continue
+            found = True
+            for receipt in glob.glob(os.path.join(path, "*.plist")):
+                try:
+                    with open(receipt, "rb") as f:
+                        plist = plistlib.load(f)
+                    receipts[plist["PackageIdentifier"]] = plist["PackageVersion"]
+                except Exception as err:
+                    iaslog("Could not read receipt %s: %s" % (receipt, err))
+        return receipts if found else None
+
+    def receipt(self, packageid):
+        """Returns the installed version of packageid, or None"""
+        for path in self.paths:
+            receipt = os.path.join(path, packageid + ".plist")
+            try:
+                with open(receipt, "rb") as f:
+                    return plistlib.load(f)["PackageVersion"]
+            except FileNotFoundError:
+                continue
+            except Exception as err:
+                iaslog("Could not read receipt %s: %s" % (receipt, err))
+        return None
+
+
+class PkgutilReceiptSource(object):
+    """Asks pkgutil about one package at a time. Slower, but used when the
+    receipts database can't be read directly."""
+
+    def receipts(self):
+        return None
+
+    def version(self, packageid):
+        try:
+            cmd = ["/usr/sbin/pkgutil", "--pkg-info-plist", packageid]
+            proc = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            receiptout = proc.communicate()[0]
+            if receiptout:
+                return plistlib.loads(receiptout)["pkg-version"]
+        except Exception:
+            pass
+        return NOT_INSTALLED
+
+
+@functools.lru_cache(maxsize=None)
+def version_key(version):
+    """Parsed, comparable form of a version string, parsed once per run"""
+    return LooseVersion(version)
+
+
+class ReceiptIndex(object):
+    """Installed package versions for the run, read from source in one scan
+    the first time they are needed. If source can't be read, each lookup
+    falls back to fallback. refresh() a package after installing it so the
+    next lookup sees its new receipt."""
+
+    def __init__(self, source, fallback=None):
+        self.source = source
+        self.fallback = fallback or PkgutilReceiptSource()
+        self.receipts = None
+        self.scanned = False
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if not self.scanned:
+            self.receipts = self.source.receipts()
+            self.scanned = True
+            if self.receipts is None:
+                iaslog("Receipts database not readable, using pkgutil")
+            else:
+                iaslog("Indexed %d package receipts" % len(self.receipts))
+
+    def versions(self, packageids):
+        """Returns {packageid: installed version} for all of packageids"""
+        with self.lock:
+            self._load()
+            receipts = self.receipts
+        if receipts is None:
+            return dict((id, self.fallback.version(id)) for id in packageids)
+        return dict((id, receipts.get(id, NOT_INSTALLED)) for id in packageids)
+
+    def version(self, packageid):
+        return self.versions([packageid])[packageid]
+
+    def installed(self, packageid, version):
+        """Returns True if packageid is installed at version or newer"""
+        return version_key(self.version(packageid)) >= version_key(version)
+
+    def refresh(self, packageid):
+        """Re-reads the receipt for packageid, keeping the rest of the index"""
+        with self.lock:
+            if self.receipts is None:
+                return
+            version = self.source.receipt(packageid)
+            if version is None:
+                self.receipts.pop(packageid, None)
+            else:
+                self.receipts[packageid] = version
 
 
 def checkreceipt(packageid):
-    try:
-        cmd = ["/usr/sbin/pkgutil", "--pkg-info-plist", packageid]
-        proc = subprocess.Popen(
-            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        output = proc.communicate()
-        receiptout = output[0]
-        if receiptout:
-            plist = plistlib.loads(receiptout)
-            version = plist["pkg-version"]
-        else:
-            version = "0.0.0.0.0"
-        return version
-    except Exception:
-        version = "0.0.0.0.0"
-        return version
+    if g_receipts is None:
+        return PkgutilReceiptSource().version(packageid)
+    return g_receipts.version(packageid)
+
+
+def receipt_installed(packageid, version):
+    """Returns True if packageid is installed at version or newer"""
+    if g_receipts is None:
+        return version_key(checkreceipt(packageid)) >= version_key(version)
+    return g_receipts.installed(packageid, version)
+
+
+class HashCache(object):
+    """On-disk cache of file hashes keyed by path and validated against the
+    file's size, mtime and inode, so files that haven't changed since they
+    were last hashed don't need to be read again."""
+
+    def __init__(self, path, max_entries=512):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        try:
+            with open(path, "rb") as cachefile:
+                self.entries = plistlib.load(cachefile)
+        except Exception:
+            self.entries = {}
+
+    def _identity(self, filename):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def lookup(self, filename):
+        """Returns the cached hash for filename, or None if the file is
+        unknown or has changed since it was hashed."""
+        identity = self._identity(filename)
+        with self.lock:
+            entry = self.entries.get(filename)
+            if not entry or identity is None or entry["identity"] != identity:
+                return None
+            entry["used"] = time.time()
+            return entry["hash"]
+
+    def store(self, filename, digest):
+        identity = self._identity(filename)
+        if identity is None:
+            return
+        with self.lock:
+            self.entries[filename] = {
+                "identity": identity,
+                "hash": digest,
+                "used": time.time(),
+            }
+            # Evict the least recently used entries
+            while len(self.entries) > self.max_entries:
+                oldest = min(self.entries, key=lambda k: self.entries[k]["used"])
+                del self.entries[oldest]
+            self.save()
+
+    def save(self):
+        tmppath = self.path + ".tmp"
+        try:
+            with open(tmppath, "wb") as cachefile:
+                plistlib.dump(self.entries, cachefile)
+            os.rename(tmppath, self.path)
+        except Exception as err:
+            iaslog("Could not save hash cache %s: %s" % (self.path, err))
 
 
 def gethash(filename):
     hash_function = hashlib.sha256()
     if not os.path.isfile(filename):
         return "NOT A FILE"
+    if g_hash_cache is not None:
+        cached = g_hash_cache.lookup(filename)
+        if cached:
+            return cached
 
     fileref = open(filename, "rb")
     while 1:
@@ -267,7 +675,191 @@ def gethash(filename):
             break
         hash_function.update(chunk)
     fileref.close()
-    return hash_function.hexdigest()
+    digest = hash_function.hexdigest()
+    if g_hash_cache is not None:
+        g_hash_cache.store(filename, digest)
+    return digest
+
+
+class PackageStore(object):
+    """Content addressed store of verified payloads, named by their hash.
+    It lives outside of iapath so it survives cleanup(), which lets identical
+    payloads be fetched once across items and runs. Once it grows past
+    max_size bytes, the least recently used payloads are removed."""
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o755)
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, digest)
+
+    def _touch(self, blob):
+        # Track use with atime so mtime, and the hash cache, stay valid
+        stat = os.stat(blob)
+        os.utime(blob, ns=(time.time_ns(), stat.st_mtime_ns))
+
+    def materialize(self, digest, destination, hardlink=True):
+        """Puts the stored payload for digest at destination. Returns False
+        if the store doesn't have it."""
+        blob = self.blob_path(digest)
+        with self.lock:
+            if not os.path.isfile(blob) or gethash(blob) != digest:
+                return False
+            if os.path.lexists(destination):
+                os.remove(destination)
+            if hardlink:
+                downloadutils.link_or_clone(blob, destination)
+            else:
+                downloadutils.clone_file(blob, destination)
+            self._touch(blob)
+        return True
+
+    def add(self, source, digest, hardlink=True):
+        """Adds a verified payload to the store"""
+        blob = self.blob_path(digest)
+        with self.lock:
+            if os.path.isfile(blob):
+                self._touch(blob)
+                return
+            tmppath = blob + ".tmp"
+            if os.path.lexists(tmppath):
+                os.remove(tmppath)
+            try:
+                if hardlink:
+                    downloadutils.link_or_clone(source, tmppath)
+                else:
+                    downloadutils.clone_file(source, tmppath)
+                os.rename(tmppath, blob)
+            except (IOError, OSError) as err:
+                iaslog("Could not add %s to package store: %s" % (source, err))
+
+    def prune(self):
+        """Removes least recently used payloads until the store fits in
+        max_size"""
+        blobs = []
+        for name in os.listdir(self.path):
+            blob = os.path.join(self.path, name)
+            if name.endswith(".tmp"):
+                os.remove(blob)
+                continue
+            stat = os.stat(blob)
+            blobs.append((stat.st_atime, stat.st_size, blob))
+        total = sum(size for _, size, _ in blobs)
+        for _, size, blob in sorted(blobs):
+            if total <= self.max_size:
+                break
+            iaslog("Removing %s from package store" % blob)
+            os.remove(blob)
+            total -= size
+
+
+def restore_from_store(item):
+    """Returns True if item's payload was put in place from the package
+    store. Packages are hardlinked; scripts are copied since their
+    permissions get changed."""
+    if g_package_store is None:
+        return False
+    hardlink = os.path.splitext(item["file"])[1] == ".pkg"
+    if g_package_store.materialize(item["hash"], item["file"], hardlink):
+        iaslog("Using stored copy of %s" % item["name"])
+        return True
+    return False
+
+
+class SeedIndex(object):
+    """Finds payloads in local seed directories (a USB drive, a file share)
+    by their hash, so they don't have to be downloaded. Each directory is
+    first checked for a file with the item's name or named after its hash.
+    If neither matches, the seed directories are listed once and only the
+    files with the item's size are hashed, each at most once per run. Items
+    without a size fall back to hashing every seed file."""
+
+    def __init__(self, directories):
+        self.directories = directories
+        self.sizes = None
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+    def _build_index(self):
+        sizes = {}
+        for directory in self.directories:
+            iaslog("Indexing seed directory %s" % directory)
+            for root, dirs, files in os.walk(directory):
+                for filename in files:
+                    path = os.path.join(root, filename)
+                    try:
+                        sizes.setdefault(os.path.getsize(path), []).append(path)
+                    except OSError as err:
+                        iaslog("Could not read seed %s: %s" % (path, err))
+        return sizes
+
+    def _hash(self, path):
+        # Hashing happens outside the lock so one large seed file doesn't
+        # hold up lookups for other items
+        with self.lock:
+            if path in self.hashes:
+                return self.hashes[path]
+        try:
+            digest = gethash(path)
+        except OSError as err:
+            iaslog("Could not hash seed %s: %s" % (path, err))
+            digest = None
+        with self.lock:
+            self.hashes[path] = digest
+        return digest
+
+    def find(self, item):
+        """Returns the path of a seed file matching item's hash, or None"""
+        hash = item["hash"]
+        names = (os.path.basename(item["file"]), hash,
+                 hash + os.path.splitext(item["file"])[1])
+        for directory in self.directories:
+            for name in names:
+                path = os.path.join(directory, name)
+                if os.path.isfile(path) and gethash(path) == hash:
+                    return path
+        with self.lock:
+            if self.sizes is None:
+                self.sizes = self._build_index()
+            if item.get("size"):
+                candidates = list(self.sizes.get(item["size"], []))
+            else:
+                candidates = [path for paths in self.sizes.values()
+                              for path in paths]
+        for path in candidates:
+            if self._hash(path) == hash:
+                return path
+        return None
+
+
+def restore_from_seed(item):
+    """Returns True if item's payload was copied from a seed directory. The
+    copy is cloned where the filesystem supports it and checked against the
+    item's hash before it replaces anything."""
+    if g_seed_index is None:
+        return False
+    source = g_seed_index.find(item)
+    if source is None:
+        return False
+    path = item["file"]
+    tmppath = path + ".seed"
+    try:
+        downloadutils.clone_file(source, tmppath)
+        if gethash(tmppath) != item["hash"]:
+            iaslog("Seed copy of %s failed hash check" % item["name"])
+            os.remove(tmppath)
+            return False
+        downloadutils.unshare(path)
+        os.rename(tmppath, path)
+    except OSError as err:
+        iaslog("Could not copy %s from seed %s: %s" % (item["name"], source, err))
+        return False
+    iaslog("Using seed copy of %s from %s" % (item["name"], source))
+    return True
 
 
 def launchctl(*arg):
@@ -278,57 +870,601 @@ def launchctl(*arg):
     return output
 
 
-def process_request_options(options):
+class MiddlewareRegistry(object):
     """
-    Checks ia folder for a file that starts with middleware.
-    If the file exists options dict is changed.
-    Taken from:
+    Loads the middleware module once: the file in the ia folder whose name
+    starts with middleware. The module can define any of these hooks:
+
+    process_request_options(options) - returns the changed options dict
+    pre_download(item) - before each download attempt of an item
+    post_download(item, received_hash) - after each download attempt
+    pre_install(item) - before a package, rootscript or userscript runs
+    install_progress(item, percent, phase) - as installer reports progress
+
+    Every hook call is timed. The changes process_request_options() makes
+    (signed URLs, auth headers) are cached per URL until the epoch time the
+    middleware returns in options["middleware_expires"], or for ttl
+    seconds, so retries and resumed downloads don't re-sign each time.
+    Adapted from:
     https://github.com/munki/munki/blob/main/code/client/munkilib/fetch.py
     """
-    middleware_file = None
-    ia_dir = os.path.realpath(os.path.dirname(sys.argv[0]))
-    for name in os.listdir(ia_dir):
-        if name.startswith('middleware'):
-            middleware_file = os.path.splitext(name)[0]
-    if middleware_file:
-        globals()['middleware'] = __import__(middleware_file,
-                                             fromlist=[middleware_file])
-        # middleware module must have this function
-        options = middleware.process_request_options(options)
-    return options
 
+    HOOKS = ("process_request_options", "pre_download", "post_download",
+             "pre_install", "install_progress")
+    # Called too often to log each call, they only show up in the summary
+    QUIET_HOOKS = ("install_progress",)
+    # Don't hand out cached options this close to expiring, or within this
+    # fraction of their lifetime for short lived ones
+    EXPIRY_MARGIN = 30
+    EXPIRY_FRACTION = 0.1
+
+    def __init__(self, ia_dir, ttl=0):
+        self.module = None
+        self.timings = {}
+        self.ttl = ttl
+        self.options_cache = {}
+        self.lock = threading.Lock()
+        middleware_file = None
+        for name in os.listdir(ia_dir):
+            if name.startswith("middleware"):
+                middleware_file = os.path.splitext(name)[0]
+        if middleware_file:
+            self.module = __import__(middleware_file, fromlist=[middleware_file])
+            hooks = [hook for hook in self.HOOKS if hasattr(self.module, hook)]
+            iaslog("Loaded middleware %s with hooks: %s"
+                   % (middleware_file, ", ".join(hooks)))
+
+    def call(self, hook, *args):
+        """Calls hook if the middleware defines it. Returns its result, or
+        None if it isn't defined."""
+        function = getattr(self.module, hook, None)
+        if function is None:
+            return None
+        started = time.time()
+        try:
+            return function(*args)
+        except Exception as err:
+            if hook == "process_request_options":
+                raise
+            # The other hooks are optional extras and mustn't stop the run
+            iaslog("Middleware %s failed: %s" % (hook, err))
+            return None
+        finally:
+            elapsed = time.time() - started
+            with self.lock:
+                count, total = self.timings.get(hook, (0, 0.0))
+                self.timings[hook] = (count + 1, total + elapsed)
+            if hook not in self.QUIET_HOOKS:
+                iaslog("Middleware %s took %.3f seconds" % (hook, elapsed))
+
+    def process_request_options(self, options):
+        """Returns options as changed by the middleware, from the cache if
+        it has an unexpired entry for the URL"""
+        if not hasattr(self.module, "process_request_options"):
+            return options
+        url = options.get("url")
+        now = time.time()
+        with self.lock:
+            cached = self.options_cache.get(url)
+        if cached and cached[0] > now:
+            iaslog("Using cached middleware options for %s" % url)
+            result = dict(options)
+            result.update(copy.deepcopy(cached[1]))
+            return result
+        # middleware usually changes options in place, so keep the original
+        # around to work out what it changed
+        original = copy.deepcopy(options)
+        result = self.call("process_request_options", options)
+        if result is None:
+            return options
+        expires = result.pop("middleware_expires", None)
+        if expires is None and self.ttl:
+            expires = now + self.ttl
+        if expires:
+            margin = min(self.EXPIRY_MARGIN, (expires - now) * self.EXPIRY_FRACTION)
+            changes = dict(
+                (key, copy.deepcopy(value))
+                for key, value in result.items()
+                if original.get(key) != value
+            )
+            with self.lock:
+                self.options_cache[url] = (expires - margin, changes)
+        return result
 
-def downloadfile(options):
-    # Process options if middleware exists
-    options = process_request_options(options)
-    connection = gurl.Gurl.alloc().initWithOptions_(options)
-    percent_complete = -1
-    bytes_received = 0
-    connection.start()
+    def log_timings(self):
+        for hook, (count, total) in sorted(self.timings.items()):
+            iaslog("Middleware %s ran %s times for %.3f seconds"
+                   % (hook, count, total))
+
+
+def process_request_options(options):
+    """
+    If middleware was loaded and defines process_request_options(), pass
+    options through it. Otherwise options are returned unchanged.
+    """
+    if g_middleware is None:
+        return options
+    return g_middleware.process_request_options(options)
+
+
+def middleware_hook(hook, *args):
+    """Calls one of the other middleware hooks, if it is defined"""
+    if g_middleware is not None:
+        g_middleware.call(hook, *args)
+
+
+class RetryPolicy(object):
+    """Capped exponential backoff with full jitter. Attempt n waits a random
+    time between 0 and min(cap, base * factor ** (n - 1)) seconds, so a fleet
+    retrying after the same outage spreads out instead of retrying in
+    lockstep.
+
+    Failures are sorted into ERROR_CLASSES by failure_class(). A failure in
+    one of the fatal classes is not retried. max_attempts of 0 retries
+    forever. Throttled requests are the server pacing us rather than
+    something going wrong, so they don't count towards max_attempts."""
+
+    ERROR_CLASSES = ("network", "server", "client", "hash", "throttled")
+
+    def __init__(self, base=5, factor=2, cap=300, jitter=True, max_attempts=4,
+                 fatal=()):
+        self.base = base
+        self.factor = factor
+        self.cap = cap
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.fatal = tuple(fatal)
+
+    def copy(self, **kwargs):
+        """Returns a copy of the policy with kwargs replaced"""
+        settings = dict(
+            base=self.base,
+            factor=self.factor,
+            cap=self.cap,
+            jitter=self.jitter,
+            max_attempts=self.max_attempts,
+            fatal=self.fatal,
+        )
+        settings.update(kwargs)
+        return RetryPolicy(**settings)
+
+    def for_item(self, item):
+        """Returns the policy for item. The "retry" dictionary overrides
+        any of the settings. The older retries/retrywait keys still work and
+        map to max_attempts (retries plus the first attempt) and base."""
+        settings = {}
+        if "retries" in item:
+            settings["max_attempts"] = int(item["retries"]) + 1
+        if "retrywait" in item:
+            settings["base"] = float(item["retrywait"])
+        settings.update(item.get("retry", {}))
+        unknown = set(settings) - set(
+            ("base", "factor", "cap", "jitter", "max_attempts", "fatal")
+        )
+        if unknown:
+            iaslog("Ignoring unknown retry settings for %s: %s"
+                   % (item.get("name"), ", ".join(sorted(unknown))))
+            for key in unknown:
+                del settings[key]
+        fatal = settings.get("fatal")
+        if isinstance(fatal, str):
+            settings["fatal"] = (fatal,)
+        elif fatal is not None and not isinstance(fatal, (list, tuple)):
+            iaslog("Ignoring retry fatal setting for %s: %r is not a list"
+                   % (item.get("name"), fatal))
+            del settings["fatal"]
+        unknown = set(settings.get("fatal", ())) - set(self.ERROR_CLASSES)
+        if unknown:
+            iaslog("Unknown error classes in retry fatal setting for %s: %s"
+                   % (item.get("name"), ", ".join(sorted(map(str, unknown)))))
+        return self.copy(**settings)
+
+    def should_retry(self, attempt, error_class):
+        """Returns True if another attempt should follow failed attempt
+        number `attempt` (counting from 1)"""
+        if error_class in self.fatal:
+            return False
+        if error_class == "throttled":
+            return True
+        return not self.max_attempts or attempt < self.max_attempts
+
+    def delay(self, attempt):
+        """Returns the seconds to wait after failed attempt `attempt`"""
+        backoff = min(self.cap, self.base * self.factor ** (attempt - 1))
+        if self.jitter:
+            return random.uniform(0, backoff)
+        return backoff
+
+    def wait(self, attempt, limit=None):
+        """Sleeps before the next attempt, for no longer than limit seconds
+        if given. Waits at least as long as a server asked with
+        Retry-After."""
+        delay = max(self.delay(attempt), pace_remaining())
+        if limit is not None:
+            delay = max(0, min(delay, limit))
+        iaslog("Waiting %.1f seconds before attempting download again..." % delay)
+        time.sleep(delay)
+
+
+def failure_class(connection):
+    """Sorts a finished download into one of RetryPolicy.ERROR_CLASSES.
+    Anything that isn't a network or HTTP error is treated as a hash
+    failure, as the only other way for a download to fail is to deliver the
+    wrong bytes."""
+    status = getattr(connection, "status", None)
+    error = getattr(connection, "error", None)
+    if error is not None and error.code() == downloadutils.SIZE_MISMATCH_ERROR:
+        # The server answered, but not with the file
+        return "hash"
+    if status == 429 or (status == 503 and retry_after(connection) is not None):
+        return "throttled"
+    if status and status >= 500:
+        return "server"
+    if status and status >= 400:
+        return "client"
+    if error is not None:
+        return "network"
+    return "hash"
+
+
+class MirrorRanker(object):
+    """Ranks mirror hosts by the estimated time to download a megabyte from
+    them: the time a TCP connection took to open, plus what the throughput
+    downloads from the host actually got says a megabyte would take. Hosts
+    are only probed when a choice has to be made between them, and each host
+    is probed once per run."""
+
+    REFERENCE_SIZE = 1024 * 1024
+
+    def __init__(self, timeout=2):
+        self.timeout = timeout
+        self.latency = {}
+        self.throughput = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def host(url):
+        parsed = urllib.parse.urlparse(url)
+        default_port = 443 if parsed.scheme == "https" else 80
+        return parsed.hostname, parsed.port or default_port
+
+    def _probe_host(self, host):
+        started = time.time()
+        try:
+            socket.create_connection(host, self.timeout).close()
+            latency = time.time() - started
+        except (OSError, ValueError):
+            latency = float("inf")
+        with self.lock:
+            self.latency[host] = latency
+        iaslog("Mirror probe of %s:%s took %.3f seconds" % (host + (latency,)))
+
+    def probe(self, urls):
+        """Measures the connection latency to any of the hosts in urls that
+        haven't been probed yet, in parallel"""
+        hosts = set(self.host(url) for url in urls if self.host(url)[0])
+        if len(hosts) < 2:
+            return
+        with self.lock:
+            hosts = [host for host in hosts if host not in self.latency]
+        threads = [
+            threading.Thread(target=self._probe_host, args=(host,))
+            for host in hosts
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def record(self, url, size, seconds):
+        """Folds the throughput of a finished download into the host's
+        estimate"""
+        if size < 2 ** 16 or seconds <= 0:
+            # Too small to say anything about the host's bandwidth
+            return
+        host = self.host(url)
+        with self.lock:
+            previous = self.throughput.get(host)
+            current = size / seconds
+            if previous is not None:
+                current = 0.5 * previous + 0.5 * current
+            self.throughput[host] = current
+
+    def cost(self, url):
+        host = self.host(url)
+        with self.lock:
+            cost = self.latency.get(host, 0)
+            if self.throughput.get(host):
+                cost += self.REFERENCE_SIZE / self.throughput[host]
+        return cost
+
+
+class MirrorSet(object):
+    """The URLs one item (or bootstrap.json) can be downloaded from. `urls`
+    is either a single URL or a list of mirrors. choose() returns the best
+    ranked mirror that has failed the fewest times for this download, so
+    each failure fails over to the next mirror until all have been tried,
+    with ties going to manifest order."""
+
+    def __init__(self, urls):
+        if not isinstance(urls, list):
+            urls = [urls]
+        self.urls = urls
+        self.failures = dict.fromkeys(urls, 0)
+        self.current = None
+        if g_mirror_ranker is not None:
+            g_mirror_ranker.probe(urls)
+
+    def choose(self):
+        def rank(url):
+            cost = g_mirror_ranker.cost(url) if g_mirror_ranker else 0
+            return self.failures[url], cost
+
+        self.current = min(self.urls, key=rank)
+        return self.current
+
+    def failed(self):
+        """Records that the current mirror failed. Returns True if there is
+        still a mirror that hasn't failed to move on to."""
+        self.failures[self.current] += 1
+        if min(self.failures.values()) == 0:
+            iaslog("Failing over from mirror %s"
+                   % urllib.parse.unquote(self.current))
+            return True
+        return False
+
+
+def record_mirror(name, url):
+    """Notes the mirror an item was served from in ia_item_runtimes.plist"""
+    try:
+        with g_runtimes_lock:
+            ias_item_runtimes_dict.setdefault("mirrors", {})[name] = url
+    except NameError:
+        pass
+
+
+def probe_network(url, timeout):
+    """Checks that the host in url can be looked up and connected to, with a
+    TLS handshake for https. Returns None if it can, otherwise a description
+    of the step that failed. The certificate isn't checked: the clock can
+    be wrong this early, and the real download verifies it anyway."""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return None
+    host = parsed.hostname
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    # getaddrinfo() can't be given a timeout, so look the name up in a
+    # thread that is abandoned if it takes too long
+    lookup = {}
+
+    def resolve():
+        try:
+            lookup["addresses"] = socket.getaddrinfo(
+                host, port, 0, socket.SOCK_STREAM
+            )
+        except (OSError, UnicodeError) as err:
+            lookup["error"] = err
+
+    thread = threading.Thread(target=resolve)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        return "DNS lookup of %s timed out" % host
+    if "error" in lookup:
+        return "DNS lookup of %s failed: %s" % (host, lookup["error"])
+    family, socktype, proto, _, address = lookup["addresses"][0]
+    sock = socket.socket(family, socktype, proto)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+        if parsed.scheme == "https":
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            sock = context.wrap_socket(sock, server_hostname=host)
+    except (OSError, ssl.SSLError) as err:
+        return "Could not connect to %s:%s: %s" % (host, port, err)
+    finally:
+        sock.close()
+    return None
+
+
+def wait_for_network(urls, timeout, probe_timeout=5):
+    """Waits until the manifest host is reachable, backing off between
+    probes, and logs how long that took. Mirrors are probed in turn. Gives
+    up after timeout seconds and lets the download handle it, in case the
+    probe can't see a network the download can (e.g. through a proxy).
+    Returns the seconds spent waiting."""
+    if not isinstance(urls, list):
+        urls = [urls]
+    backoff = RetryPolicy(base=0.5, factor=2, cap=10, max_attempts=0)
+    started = time.time()
+    attempt = 0
+    while True:
+        url = urls[attempt % len(urls)]
+        attempt += 1
+        failure = probe_network(url, probe_timeout)
+        waited = time.time() - started
+        if failure is None:
+            iaslog("Network ready after %.1f seconds (%s probes)"
+                   % (waited, attempt))
+            return waited
+        iaslog("Network not ready: %s" % failure)
+        if waited >= timeout:
+            iaslog("Network still not ready after %.1f seconds, continuing "
+                   "anyway" % waited)
+            return waited
+        time.sleep(min(backoff.delay(attempt), timeout - waited))
+
+
+def header_value(headers, name):
+    """Returns the value of a response header, ignoring case, or None"""
+    for key, value in (headers or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def retry_after(connection):
+    """Returns the seconds a 429 or 503 response asked us to wait before
+    trying again, from a Retry-After header holding either seconds or an
+    HTTP date. Returns None for any other response."""
+    if getattr(connection, "status", None) not in (429, 503):
+        return None
+    value = header_value(connection.headers, "Retry-After")
+    if value is None:
+        return None
+    value = str(value).strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        iaslog("Ignoring malformed Retry-After header: %s" % value)
+        return None
+    return max(0, when.timestamp() - time.time())
+
+
+def pace_downloads(seconds):
+    """Holds back every new download, including prefetches, for the time a
+    server asked for (capped by --max-retry-after). Up to a tenth extra is
+    added at random so clients that were turned away together don't all
+    come back at once."""
+    global g_pace_until
+    seconds = min(seconds, g_max_retry_after)
+    until = time.time() + seconds + random.uniform(0, seconds * 0.1)
+    with g_pace_lock:
+        if until > g_pace_until:
+            g_pace_until = until
+            iaslog("Server asked to retry after %s seconds, pausing downloads"
+                   % int(seconds))
+
+
+def pace_remaining():
+    """Returns the seconds left before downloads may start again"""
+    return max(0, g_pace_until - time.time())
+
+
+def wait_for_pacing():
+    remaining = pace_remaining()
+    if remaining > 0:
+        iaslog("Waiting %.1f seconds for the server to accept downloads again..."
+               % remaining)
+        time.sleep(remaining)
+
+
+def reload_throttle_config():
+    """Re-reads the --throttle-config plist if it changed since it was last
+    read, so the global rate limit can be adjusted while a run is in
+    progress. If the file is removed the limit goes back to --rate-limit."""
+    global g_throttle_mtime
+    if not g_throttle_config:
+        return
+    try:
+        mtime = os.stat(g_throttle_config).st_mtime
+    except OSError:
+        mtime = None
+    if mtime == g_throttle_mtime:
+        return
+    g_throttle_mtime = mtime
+    rate = g_rate_limit
+    if mtime is not None:
+        try:
+            with open(g_throttle_config, "rb") as fileref:
+                rate = int(plistlib.load(fileref).get("rate_limit", rate))
+        except Exception as err:
+            iaslog("Could not read throttle config %s: %s"
+                   % (g_throttle_config, err))
+            return
+    if rate:
+        iaslog("Download rate limit set to %s KB/s" % rate)
+    else:
+        iaslog("Download rate limit removed")
+    g_rate_limiter.set_rate(rate * 1024)
+
+
+def wants_decompress(options):
+    """Returns True if the download is a pre-compressed .gz artifact that
+    should be stored decompressed. Items can set "decompress" to decide
+    for themselves; otherwise a .gz URL for a file that doesn't end in .gz
+    is decompressed."""
+    if "decompress" in options:
+        return bool(options["decompress"])
+    return urllib.parse.urlparse(options["url"]).path.endswith(".gz") and not (
+        options["file"].endswith(".gz")
+    )
+
+
+def item_rate_limiter(options):
+    """Returns the bucket for the item's own rate_limit (KB/s), or None.
+    Every connection for the item, segments and retries included, shares
+    the same bucket. Buckets hold a lock, so they are kept here rather than
+    in the options handed to middleware."""
+    rate = options.get("rate_limit")
+    if not rate:
+        return None
+    with g_item_limiters_lock:
+        limiter = g_item_limiters.get(options["name"])
+        if limiter is None:
+            limiter = downloadutils.TokenBucket(rate * 1024)
+            g_item_limiters[options["name"]] = limiter
+        return limiter
+
+
+def new_connection(options):
+    """Returns an unstarted download connection for options using the
+    selected transport. Both transports take the same options and expose
+    the same interface."""
+    # Transport messages (resumes, redirects, size checks) go to our log
+    options = dict(options, logging_function=iaslog)
+    if urllib.parse.urlparse(options["url"]).scheme == "file":
+        return poolurl.FileUrl(options)
+    limiters = [g_rate_limiter] if g_rate_limiter is not None else []
+    item_limiter = item_rate_limiter(options)
+    if item_limiter is not None:
+        limiters.append(item_limiter)
+    if limiters:
+        options = dict(
+            options,
+            rate_limiters=limiters + list(options.get("rate_limiters", [])),
+        )
+    if g_transport == "pool":
+        return poolurl.PoolUrl(options)
+    return gurl.Gurl.alloc().initWithOptions_(options)
+
+
+def downloadfile(options, skip_middleware=False):
+    # Process options if middleware exists, unless the caller already has
+    if not skip_middleware:
+        options = process_request_options(options)
     try:
         filename = options["name"]
     except KeyError:
         iaslog("No 'name' key defined in json for %s" % pkgregex(options["file"]))
         sys.exit(1)
 
-    try:
-        while not connection.isDone():
-            if connection.destination_path:
-                # only print progress info if we are writing to a file
-                if connection.percentComplete != -1:
-                    if connection.percentComplete != percent_complete:
-                        percent_complete = connection.percentComplete
-                        iaslog(
-                            "Downloading %s - Percent complete: %s "
-                            % (filename, percent_complete)
-                        )
-                elif connection.bytesReceived != bytes_received:
-                    bytes_received = connection.bytesReceived
-                    iaslog(
-                        "Downloading %s - Bytes received: %s "
-                        % (filename, bytes_received)
-                    )
+    def log_progress(connection):
+        if connection.percentComplete != -1:
+            iaslog(
+                "Downloading %s - Percent complete: %s "
+                % (filename, connection.percentComplete)
+            )
+        else:
+            iaslog(
+                "Downloading %s - Bytes received: %s "
+                % (filename, connection.bytesReceived)
+            )
 
+    if wants_decompress(options):
+        # Only the compressed stream can be resumed, and that isn't kept
+        options = dict(options, decompress=True, can_resume=False)
+    wait_for_pacing()
+    connection = new_connection(dict(options, progress_callback=log_progress))
+    started = time.time()
+    connection.start()
+    try:
+        connection.wait()
     except (KeyboardInterrupt, SystemExit):
         # safely kill the connection then fall through
         connection.cancel()
@@ -338,6 +1474,30 @@ def downloadfile(options):
         # Re-raise the error
         raise
 
+    log_connection_result(connection)
+    if connection.writeCount:
+        iaslog(
+            "Wrote %s bytes of %s in %s writes and %s syncs, %.2f seconds "
+            "spent writing"
+            % (
+                connection.bytesWritten,
+                filename,
+                connection.writeCount,
+                connection.syncCount,
+                connection.writeTime,
+            )
+        )
+    delay = retry_after(connection)
+    if delay is not None:
+        pace_downloads(delay)
+    if g_mirror_ranker is not None and connection.error is None:
+        g_mirror_ranker.record(
+            options["url"], connection.bytesReceived, time.time() - started
+        )
+    return connection
+
+
+def log_connection_result(connection):
     if connection.error is not None:
         iaslog(
             "Error: %s %s "
@@ -355,6 +1515,207 @@ def downloadfile(options):
         iaslog("Redirection: %s " % (str(connection.redirection)))
 
 
+def content_range_total(headers):
+    """Returns the full size of the file from a Content-Range header such as
+    'bytes 0-0/1234', or None if it isn't known"""
+    value = header_value(headers, "Content-Range")
+    if value is not None:
+        total = str(value).rpartition("/")[2].strip()
+        if total.isdigit():
+            return int(total)
+    return None
+
+
+def downloadfile_segmented(options, segments, min_size):
+    """Downloads a file as several byte ranges fetched concurrently and
+    written in place. A one byte probe request finds out whether the server
+    honors Range requests and how big the file is.
+
+    Returns True if the segmented download completed. Otherwise the file was
+    fetched as a single stream and the connection for that is returned."""
+    path = options["file"]
+    name = options["name"]
+    # Segments are written over whatever is there, so any stored resume
+    # data no longer applies.
+    downloadutils.remove_stored_headers(path)
+    # Run middleware once for all of the segments
+    options = process_request_options(dict(options, can_resume=False))
+    probe = downloadfile(dict(options, byte_range=[0, 0]), skip_middleware=True)
+    if probe.status != 206 or probe.error is not None:
+        # Either the probe failed, or range isn't supported and the probe
+        # was a normal download of the whole file.
+        if probe.error is None:
+            iaslog("Server did not honor range request for %s" % name)
+        return probe
+    total = content_range_total(probe.headers)
+    if total is None or total < min_size:
+        return downloadfile(options, skip_middleware=True)
+
+    # Preallocate the file so each segment can seek to its offset.
+    with open(path, "r+b") as fileref:
+        fileref.truncate(total)
+    segment_size = -(-total // segments)
+    connections = []
+    progress = {"percent": -1}
+
+    def log_progress(_connection):
+        # report progress across all of the segments
+        received = sum(connection.bytesReceived for connection in connections)
+        percent_complete = int(received * 100 / total)
+        if percent_complete != progress["percent"]:
+            progress["percent"] = percent_complete
+            iaslog(
+                "Downloading %s - Percent complete: %s " % (name, percent_complete)
+            )
+
+    for start in range(0, total, segment_size):
+        end = min(start + segment_size, total) - 1
+        segment = dict(
+            options, byte_range=[start, end], progress_callback=log_progress
+        )
+        connection = new_connection(segment)
+        connections.append(connection)
+    iaslog("Downloading %s in %s segments" % (name, len(connections)))
+    for connection in connections:
+        connection.start()
+
+    try:
+        for connection in connections:
+            connection.wait()
+    except Exception:
+        for connection in connections:
+            connection.cancel()
+        raise
+
+    for connection in connections:
+        if connection.error is not None or connection.status != 206:
+            log_connection_result(connection)
+            delay = retry_after(connection)
+            if delay is not None:
+                pace_downloads(delay)
+            iaslog("Segmented download of %s failed, retrying as a single "
+                   "stream" % name)
+            return downloadfile(options, skip_middleware=True)
+    iaslog(
+        "Wrote %s bytes of %s in %s writes, %.2f seconds spent writing"
+        % (
+            sum(connection.bytesWritten for connection in connections),
+            name,
+            sum(connection.writeCount for connection in connections),
+            sum(connection.writeTime for connection in connections),
+        )
+    )
+    return True
+
+
+def fetch_item(item, opts):
+    """Downloads an item. Returns the hash of what was received and the
+    failure_class() of the download."""
+    path = item["file"]
+    # The file may share its inode with the package store
+    downloadutils.unshare(path)
+    middleware_hook("pre_download", item)
+    segments = min(item.get("segments", opts.segments), opts.max_segments)
+    if urllib.parse.urlparse(item["url"]).scheme == "file":
+        # Local copies gain nothing from being split up
+        segments = 1
+    if wants_decompress(item):
+        # A gzip stream can only be decompressed from the start
+        segments = 1
+    if segments > 1:
+        result = downloadfile_segmented(
+            item, segments, opts.segment_min_size * 1024 * 1024
+        )
+        if result is True:
+            # Segments arrive out of order so they can't be hashed as they
+            # are received.
+            received = gethash(path)
+            failure = "hash"
+        else:
+            received = downloaded_hash(result, path)
+            failure = failure_class(result)
+    else:
+        connection = downloadfile(item)
+        received = downloaded_hash(connection, path)
+        failure = failure_class(connection)
+    middleware_hook("post_download", item, received)
+    return received, failure
+
+
+def fetch_bootstrap(json_data, fallback_timeout):
+    """Downloads bootstrap.json if it has changed since the copy on disk was
+    fetched. The download goes to a temporary file that only replaces the
+    existing copy once it parses, so the copy on disk is always the last
+    known good manifest. If the server can't be reached within
+    fallback_timeout seconds, that copy is used instead.
+
+    Nothing can run without a manifest, so failures are retried with the
+    global retry policy without any attempt limit. When there are several
+    --jsonurl mirrors, each failure first fails over to the next one."""
+    policy = g_retry_policy.copy(max_attempts=0, fatal=())
+    attempt = 1
+    mirrors = MirrorSet(json_data["url"])
+    jsonpath = json_data["file"]
+    tmppath = jsonpath + ".download"
+    options = dict(json_data, file=tmppath)
+    if os.path.isfile(jsonpath):
+        options.update(
+            {
+                "download_only_if_changed": True,
+                "cache_data": downloadutils.get_stored_headers(jsonpath),
+            }
+        )
+    started = time.time()
+    while True:
+        if os.path.isfile(tmppath):
+            os.remove(tmppath)
+        options["url"] = mirrors.choose()
+        iaslog("Starting download: %s" % urllib.parse.unquote(options["url"]))
+        connection = downloadfile(options)
+        if connection.status == 304:
+            iaslog("bootstrap.json has not changed, using the existing copy")
+            return
+        if connection.error is None and os.path.isfile(tmppath):
+            try:
+                with open(tmppath) as tmpfile:
+                    json.load(tmpfile)
+            except ValueError as err:
+                iaslog("Downloaded bootstrap.json is not valid json: %s" % err)
+            else:
+                downloadutils.replace_file(tmppath, jsonpath)
+                if len(mirrors.urls) > 1:
+                    record_mirror(json_data["name"], options["url"])
+                return
+        if mirrors.failed():
+            continue
+        # The server asking us to slow down doesn't grow the backoff
+        step = 0 if failure_class(connection) == "throttled" else 1
+        if not os.path.isfile(jsonpath):
+            policy.wait(attempt)
+            attempt += step
+            continue
+        remaining = started + fallback_timeout - time.time()
+        if remaining <= 0:
+            iaslog(
+                "Could not download bootstrap.json within %s seconds, using "
+                "the last known good copy" % fallback_timeout
+            )
+            return
+        policy.wait(attempt, remaining)
+        attempt += step
+
+
+def downloaded_hash(connection, path):
+    """Returns the hash of a finished download. Gurl hashes the file as it
+    is written, so only fall back to reading it from disk when it didn't
+    write anything (e.g. the request failed and an older file is left)."""
+    if connection is not None and connection.digest:
+        if g_hash_cache is not None:
+            g_hash_cache.store(path, connection.digest)
+        return connection.digest
+    return gethash(path)
+
+
 def vararg_callback(option, opt_str, value, parser):
     # https://docs.python.org/3/library/optparse.html#callback-example-6-
     # variable-arguments
@@ -378,40 +1739,37 @@ def vararg_callback(option, opt_str, value, parser):
     setattr(parser.values, option.dest, value)
 
 
-def runrootscript(pathname, donotwait):
+def runrootscript(pathname, donotwait, timeout=None, name=None):
     """Runs script located at given pathname"""
     if g_dry_run:
         iaslog("Dry run executing root script: %s" % pathname)
         return True
+    supervisor = g_supervisor or ProcessSupervisor()
     try:
         if donotwait:
             iaslog("Do not wait triggered")
-            proc = subprocess.Popen(pathname)
+            supervisor.start(name or pathname, pathname, timeout, donotwait=True)
             iaslog("Running Script: %s " % pathname)
         else:
             iaslog("Running Script: %s " % pathname)
-            proc = subprocess.Popen(
-                pathname, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            (out, err) = proc.communicate()
-            iaslog("Output on stdout:")
-            iaslog(out.decode("utf-8"))
-            if err and proc.returncode == 0:
-                iaslog("Output on stderr but ran successfully:")
-                iaslog(err.decode("utf-8"))
-            elif proc.returncode > 0:
-                iaslog("Received non-zero exit code:")
-                iaslog(err.decode("utf-8"))
+            rcode, out, err = stream_process(pathname, name=name, timeout=timeout)
+            if rcode != 0:
+                iaslog("Received non-zero exit code: %d" % rcode)
+                log_output_tail("stderr", err)
                 return False
     except OSError as err:
         iaslog("Failure running script:")
-        iaslog(str(err.decode("utf-8")))
+        iaslog(str(err))
         return False
     return True
 
 
 def runuserscript(iauserscriptpath):
-    files = os.listdir(iauserscriptpath)
+    files = [
+        name
+        for name in os.listdir(iauserscriptpath)
+        if not name.endswith(downloadutils.SIDECAR_SUFFIX)
+    ]
     for file in files:
         pathname = os.path.join(iauserscriptpath, file)
         if g_dry_run:
@@ -420,22 +1778,14 @@ def runuserscript(iauserscriptpath):
             return True
         try:
             iaslog("Running Script: %s " % pathname)
-            proc = subprocess.Popen(
-                pathname, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-            (out, err) = proc.communicate()
-            iaslog("Output on stdout:")
-            iaslog(out.decode("utf-8"))
-            if err and proc.returncode == 0:
-                iaslog("Output on stderr but ran successfully:")
-                iaslog(err.decode("utf-8"))
-            elif proc.returncode > 0:
-                iaslog("Received non-zero exit code:")
-                iaslog(err.decode("utf-8"))
+            rcode, out, err = stream_process(pathname)
+            if rcode != 0:
+                iaslog("Received non-zero exit code: %d" % rcode)
+                log_output_tail("stderr", err)
                 return False
         except OSError as err:
             iaslog("Failure running script:")
-            iaslog(str(err.decode("utf-8")))
+            iaslog(str(err))
             return False
         os.remove(pathname)
         return True
@@ -444,65 +1794,384 @@ def runuserscript(iauserscriptpath):
         return False
 
 
-def download_if_needed(item, stage, type, retries, retrywait, opts):
-    # Process item if middleware exists
-    item = process_request_options(item)
+def peer_uid(conn):
+    """Returns the uid of the process at the other end of a Unix domain
+    socket, or None if it can't be told"""
+    try:
+        if sys.platform == "darwin":
+            # struct xucred from LOCAL_PEERCRED (SOL_LOCAL 0, option 1)
+            creds = conn.getsockopt(0, 1, struct.calcsize("IIh16I"))
+            return struct.unpack_from("II", creds)[1]
+        if hasattr(socket, "SO_PEERCRED"):
+            creds = conn.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+            )
+            return struct.unpack("3i", creds)[1]
+    except OSError as err:
+        iaslog("Could not get peer credentials: %s" % err)
+    return None
+
+
+class UserScriptChannel(object):
+    """Hands userscripts to the LaunchAgent over a Unix domain socket. The
+    trigger file is only touched to start the agent when none is connected;
+    once connected, the agent stays connected and runs each script it is
+    sent, replying with its exit code and output. If the agent doesn't
+    connect, this falls back to waiting for it to remove the trigger file.
+
+    Each message is one line of JSON. The daemon sends
+    {"script": path, "timeout": seconds} and the agent answers with
+    {"exit_code": int, "stdout": str, "stderr": str}. {"quit": true} ends
+    the session."""
+
+    def __init__(self, path, touchpath):
+        self.path = path
+        self.touchpath = touchpath
+        self.server = None
+        self.conn = None
+        self.stream = None
+
+    def listen(self):
+        try:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(self.path)
+            # The agent runs as the console user
+            os.chmod(self.path, 0o777)
+            server.listen(1)
+            self.server = server
+        except OSError as err:
+            iaslog("Could not listen on %s: %s" % (self.path, err))
+
+    def _accept(self, deadline):
+        """Waits for the agent to connect. Returns False if the agent ran
+        the script the old way (removed the trigger file) or time ran out."""
+        while True:
+            if select.select([self.server], [], [], 0.5)[0]:
+                conn = self.server.accept()[0]
+                # The socket is world writable, so make sure it is the
+                # console user's agent before trusting it with scripts
+                uid = peer_uid(conn)
+                console = getconsoleuser()
+                if uid is None or uid not in (0, console and console[1]):
+                    iaslog("Rejecting user script connection from uid %s" % uid)
+                    conn.close()
+                    continue
+                self.conn = conn
+                self.stream = self.conn.makefile("rwb")
+                iaslog("LaunchAgent connected")
+                return True
+            if not os.path.isfile(self.touchpath):
+                return False
+            if deadline is not None and time.time() > deadline:
+                return False
+
+    def _wait_for_trigger(self, path, deadline):
+        while os.path.isfile(self.touchpath):
+            if deadline is not None and time.time() > deadline:
+                iaslog("User script %s still running after its timeout, "
+                       "moving on" % path)
+                return False
+            iaslog("Waiting for user script to complete: %s" % path)
+            time.sleep(0.5)
+        return True
+
+    def _send(self, message):
+        self.stream.write(json.dumps(message).encode("utf-8") + b"\n")
+        self.stream.flush()
+
+    def run(self, path, timeout=None):
+        """Runs the userscript at path as the console user. Returns True if
+        it succeeded, or if it ran without the socket and we can't tell."""
+        deadline = time.time() + timeout if timeout else None
+        if self.stream is None:
+            iaslog("Triggering LaunchAgent for user script: %s" % path)
+            touch(self.touchpath)
+            if self.server is None or not self._accept(deadline):
+                return self._wait_for_trigger(path, deadline)
+        try:
+            self._send({"script": path, "timeout": timeout})
+            if timeout:
+                # The agent stops the script itself, give it time to report
+                self.conn.settimeout(timeout + ProcessSupervisor.GRACE + 5)
+            line = self.stream.readline()
+            if not line:
+                raise OSError("connection closed")
+            result = json.loads(line.decode("utf-8"))
+        except (OSError, ValueError) as err:
+            iaslog("Lost LaunchAgent connection running %s: %s" % (path, err))
+            self.close()
+            return False
+        finally:
+            if self.conn is not None:
+                self.conn.settimeout(None)
+        iaslog("User script %s exited with %s" % (path, result["exit_code"]))
+        if result["exit_code"] != 0:
+            log_output_tail("stderr", result["stderr"].splitlines())
+        return result["exit_code"] == 0
+
+    def close(self):
+        if self.stream is not None:
+            try:
+                self._send({"quit": True})
+            except OSError:
+                pass
+            self.stream.close()
+            self.conn.close()
+            self.stream = None
+            self.conn = None
+
+    def stop(self):
+        self.close()
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+def serve_userscripts(sockpath, touchpath, iauserscriptpath):
+    """The LaunchAgent's side of UserScriptChannel. Returns False if the
+    daemon can't be reached, so the caller can fall back to
+    runuserscript()."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sockpath)
+    except OSError as err:
+        iaslog("Could not connect to %s: %s" % (sockpath, err))
+        sock.close()
+        return False
+    stream = sock.makefile("rwb")
+    scriptdir = os.path.realpath(iauserscriptpath)
+    for line in stream:
+        try:
+            request = json.loads(line.decode("utf-8"))
+        except ValueError as err:
+            iaslog("Invalid request from daemon: %s" % err)
+            break
+        if request.get("quit"):
+            break
+        # The daemon has our attention, launchd doesn't need to relaunch us
+        if os.path.isfile(touchpath):
+            os.remove(touchpath)
+        pathname = request["script"]
+        timeout = request.get("timeout")
+        rcode, out, err = 0, [], []
+        if os.path.dirname(os.path.realpath(pathname)) != scriptdir:
+            rcode, err = 1, ["%s is not in %s" % (pathname, scriptdir)]
+        elif g_dry_run:
+            iaslog("Dry run executing user script: %s" % pathname)
+        else:
+            try:
+                iaslog("Running Script: %s " % pathname)
+                rcode, out, err = stream_process(pathname, timeout=timeout)
+            except OSError as e:
+                rcode, err = 1, [str(e)]
+        if rcode == 0 and os.path.isfile(pathname):
+            os.remove(pathname)
+        reply = {"exit_code": rcode, "stdout": "\n".join(out),
+                 "stderr": "\n".join(err)}
+        stream.write(json.dumps(reply).encode("utf-8") + b"\n")
+        stream.flush()
+    stream.close()
+    sock.close()
+    if os.path.isfile(touchpath):
+        os.remove(touchpath)
+    return True
+
+
+def needs_download(item):
+    """Returns True if item has a payload that the run will need to fetch"""
+    if not all(key in item for key in ("file", "hash", "name", "url")):
+        return False
+    if item.get("type") == "package":
+        skip_if = item.get("skip_if", False)
+        if skip_if and validate_skip_if(skip_if):
+            return False
+        if not item.get("required", False) and receipt_installed(
+            item["packageid"], item["version"]
+        ):
+            return False
+    return True
+
+
+class Prefetcher(object):
+    """Downloads upcoming items in the background while the current item is
+    installing. Installs still happen in manifest order, and
+    download_if_needed() still validates the hash before each install."""
+
+    def __init__(self, items, depth, host_concurrency, opts):
+        self.items = list(items)
+        self.positions = dict((id(item), i) for i, item in enumerate(self.items))
+        self.depth = depth
+        self.host_concurrency = host_concurrency
+        self.opts = opts
+        self.scheduled = 0
+        self.events = {}
+        self.host_semaphores = {}
+        self.lock = threading.Lock()
+        self.schedule_lock = threading.Lock()
+        self.queue = queue.Queue()
+        for _ in range(depth):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+
+    def advance(self, item):
+        """Called as the install cursor reaches item. Schedules the next
+        `depth` items, then waits for any prefetch of item to finish."""
+        index = self.positions.get(id(item))
+        if index is None or not self.depth:
+            return
+        # Parallel stages can call this from several workers at once
+        with self.schedule_lock:
+            start = max(self.scheduled, index + 1)
+            stop = min(index + self.depth + 1, len(self.items))
+            for upcoming in self.items[start:stop]:
+                if needs_download(upcoming):
+                    event = threading.Event()
+                    self.events[id(upcoming)] = event
+                    self.queue.put((upcoming, event))
+            self.scheduled = max(self.scheduled, stop)
+            event = self.events.pop(id(item), None)
+        if event is not None and not event.is_set():
+            iaslog("Waiting for prefetch of %s to finish" % item["name"])
+            event.wait()
+
+    def _host_semaphore(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(
+                    self.host_concurrency
+                )
+            return self.host_semaphores[host]
+
+    def _worker(self):
+        while True:
+            item, event = self.queue.get()
+            try:
+                self._prefetch(item)
+            except Exception as err:
+                iaslog("Prefetch failed for %s: %s" % (item["name"], err))
+            finally:
+                event.set()
+
+    def _prefetch(self, item):
+        path = item["file"]
+        if os.path.isfile(path) and item["hash"] == gethash(path):
+            return
+        if restore_from_store(item) or restore_from_seed(item):
+            return
+        url = MirrorSet(item["url"]).choose()
+        with self._host_semaphore(url):
+            iaslog("Prefetching: %s" % urllib.parse.unquote(url))
+            options = download_options(dict(item, url=url), self.opts)
+            fetch_item(options, self.opts)
+
+
+def download_options(item, opts):
+    """Returns a copy of item with the command line download options applied"""
+    options = dict(item)
+    # Check if additional headers are being passed and add
+    # them to the dictionary.
+    if opts.headers:
+        options.update({"additional_headers": {"Authorization": opts.headers}})
+    # Check if we need to follow redirects.
+    if opts.follow_redirects:
+        options.update({"follow_redirects": True})
+    # Pick up partial downloads where they left off, including ones left
+    # behind by an earlier run. Items can opt out with "can_resume": false.
+    options.setdefault("can_resume", True)
+    # Received data is written out in write_buffer_size blocks and synced to
+    # disk every sync_interval bytes
+    options.setdefault("write_buffer_size", opts.write_buffer * 1024)
+    options.setdefault("sync_interval", opts.sync_interval * 1024 * 1024)
+    # Lets the transport spot a captive portal page or truncated file as
+    # soon as the response arrives, and preallocate the file.
+    if item.get("size"):
+        options["expected_size"] = item["size"]
+    return options
+
+
+class ItemFailed(Exception):
+    """An item couldn't be downloaded and the run has to stop"""
+
+
+def download_if_needed(item, stage, type, opts):
     # Check if the file exists and matches the expected hash.
     path = item["file"]
     name = item["name"]
     hash = item["hash"]
-    itemurl = item["url"]
-    while not (os.path.isfile(path) and hash == gethash(path)):
-        # Check if additional headers are being passed and add
-        # them to the dictionary.
-        if opts.headers:
-            item.update({"additional_headers": {"Authorization": opts.headers}})
-        # Check if we need to follow redirects.
-        if opts.follow_redirects:
-            item.update({"follow_redirects": True})
-        # Download the file once:
-        iaslog("Starting download: %s" % urllib.parse.unquote(itemurl))
-        downloadfile(item)
-        # Wait half a second to process
-        time.sleep(0.5)
-        # Check the files hash and redownload until it's
-        # correct. Bail after three times and log event.
-        failsleft = retries
-        while not hash == gethash(path):
+    if not (
+        (os.path.isfile(path) and hash == gethash(path))
+        or restore_from_store(item)
+        or restore_from_seed(item)
+    ):
+        policy = g_retry_policy.for_item(item)
+        mirrors = MirrorSet(item["url"])
+        item = download_options(item, opts)
+        # Check the files hash and redownload until it's correct. A failure
+        # moves straight on to any mirror that hasn't failed yet, otherwise
+        # back off between attempts. Bail once the retry policy gives up.
+        attempt = 1
+        while True:
+            item["url"] = mirrors.choose()
+            iaslog("Starting download: %s" % urllib.parse.unquote(item["url"]))
+            received, failure = fetch_item(item, opts)
+            if hash == received:
+                break
             iaslog(
                 "Hash failed for %s - received: %s expected"
-                ": %s" % (name, gethash(path), hash)
+                ": %s" % (name, received, hash)
             )
-            iaslog("Waiting %s seconds before attempting download again..." % retrywait)
-            time.sleep(retrywait)
-            downloadfile(item)
-            failsleft -= 1
-            if failsleft == 0:
-                iaslog("Hash retry failed for %s: exiting!" % name)
-                cleanup(1)
+            if mirrors.failed():
+                continue
+            if not policy.should_retry(attempt, failure):
+                iaslog(
+                    "Hash retry failed for %s after %s attempts (%s error): "
+                    "exiting!" % (name, attempt, failure)
+                )
+                # Let the caller clean up once nothing else is running
+                raise ItemFailed(name)
+            policy.wait(attempt)
+            # The server asking us to slow down isn't a failed attempt
+            if failure != "throttled":
+                attempt += 1
         # Time to install.
-        iaslog("Hash validated - received: %s expected: %s" % (gethash(path), hash))
-        # Fix script permissions.
-        if os.path.splitext(path)[1] != ".pkg":
-            os.chmod(path, 0o755)
-        if type == "userscript":
-            os.chmod(path, 0o777)
+        iaslog("Hash validated - received: %s expected: %s" % (received, hash))
+        if len(mirrors.urls) > 1:
+            record_mirror(name, item["url"])
+    if g_package_store is not None:
+        g_package_store.add(path, hash, os.path.splitext(path)[1] == ".pkg")
+    # Fix script permissions. Done outside the download loop so payloads
+    # that were already on disk (or prefetched) are fixed up too.
+    if os.path.splitext(path)[1] != ".pkg":
+        os.chmod(path, 0o755)
+    if type == "userscript":
+        os.chmod(path, 0o777)
 
 
 def touch(path):
     try:
-        touchfile = ["/usr/bin/touch", path]
-        proc = subprocess.Popen(
-            touchfile, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        touchfileoutput, err = proc.communicate()
+        with open(path, "a"):
+            os.utime(path, None)
         os.chmod(path, 0o777)
-        return touchfileoutput
     except Exception:
         return None
 
 
 def cleanup(exit_code):
+    # Note how every process ended, including donotwait ones still running
+    record_processes()
+
+    # Let a connected LaunchAgent exit
+    if g_userscripts is not None:
+        g_userscripts.stop()
+
     # Attempt to remove the LaunchDaemon
     iaslog("Attempting to remove LaunchDaemon: %s" % ialdpath)
     try:
@@ -539,6 +2208,17 @@ def cleanup(exit_code):
         except:  # noqa
             pass
 
+    if g_middleware is not None:
+        g_middleware.log_timings()
+
+    # Trim the package store before the payloads in iapath go away
+    if g_package_store is not None:
+        iaslog("Pruning package store: %s" % g_package_store.path)
+        try:
+            g_package_store.prune()
+        except Exception as err:
+            iaslog("Could not prune package store: %s" % err)
+
     # Attempt to kill InstallApplications' path
     iaslog("Attempting to remove InstallApplications directory: %s" % iapath)
     try:
@@ -555,16 +2235,261 @@ def cleanup(exit_code):
 def write_item_total_runtime(stage, item_name, item_start_time):
     item_runtime = round(time.time() - item_start_time, 2)
     iaslog("%s item ran for %s seconds" % (item_name, item_runtime))
-    ias_item_runtimes_dict[stage].update({item_name: item_runtime})
-    with open(ias_item_runtimes_plist, 'wb') as ias_runtimes_file:
-        plistlib.dump(ias_item_runtimes_dict, ias_runtimes_file)
+    with g_runtimes_lock:
+        ias_item_runtimes_dict[stage].update({item_name: item_runtime})
+        with open(ias_item_runtimes_plist, 'wb') as ias_runtimes_file:
+            plistlib.dump(ias_item_runtimes_dict, ias_runtimes_file)
+
+
+def stage_graph(items, earlier_names):
+    """Returns, for each item in a stage, the set of item indexes it has to
+    wait for. Items without depends_on or group keys wait for everything
+    before them, group members only wait for earlier items outside their
+    group and depends_on replaces the implicit ordering entirely. Names from
+    earlier stages have already run and are ignored."""
+    indexes = {}
+    for index, item in enumerate(items):
+        indexes.setdefault(item.get("name"), []).append(index)
+    graph = []
+    for index, item in enumerate(items):
+        if "depends_on" in item:
+            names = item["depends_on"]
+            if isinstance(names, str):
+                names = [names]
+            deps = set()
+            for name in names:
+                if name in indexes:
+                    deps.update(indexes[name])
+                elif name not in earlier_names:
+                    raise ValueError(
+                        "%s depends on unknown item %s" % (item.get("name"), name)
+                    )
+        elif "group" in item:
+            deps = set(
+                j for j in range(index) if items[j].get("group") != item["group"]
+            )
+        else:
+            deps = set(range(index))
+        graph.append(deps)
+
+    # Kahn's algorithm: anything left over is part of a cycle
+    waiting = [len(deps) for deps in graph]
+    dependents = [[] for _ in items]
+    for index, deps in enumerate(graph):
+        for dep in deps:
+            dependents[dep].append(index)
+    ready = [index for index, count in enumerate(waiting) if not count]
+    while ready:
+        for dependent in dependents[ready.pop()]:
+            waiting[dependent] -= 1
+            if not waiting[dependent]:
+                ready.append(dependent)
+    cycle = [str(items[index].get("name")) for index, count in enumerate(waiting)
+             if count]
+    if cycle:
+        raise ValueError("dependency cycle between %s" % ", ".join(cycle))
+    return graph
+
+
+def stage_graphs(iajson, stages):
+    """Builds the dependency graph for every stage up front so a bad
+    bootstrap.json fails before anything is installed."""
+    graphs = {}
+    earlier_names = set()
+    for stage in stages:
+        items = iajson.get(stage, [])
+        try:
+            graphs[stage] = stage_graph(items, earlier_names)
+        except ValueError as err:
+            raise ValueError("%s: %s" % (stage, err))
+        earlier_names.update(item.get("name") for item in items)
+    return graphs
+
+
+def run_stage(stage, items, graph, max_workers, run_item):
+    """Runs run_item for each item once everything it depends on is done,
+    with up to max_workers items in flight. When several items are ready
+    the earliest in bootstrap.json goes first. Stages without depends_on or
+    group keys, and preflight, run strictly in order on this thread."""
+    parallel = (
+        stage != "preflight"
+        and max_workers > 1
+        and any("depends_on" in item or "group" in item for item in items)
+    )
+    if not parallel:
+        for item in items:
+            run_item(item)
+        return
+
+    waiting = [set(deps) for deps in graph]
+    dependents = [[] for _ in items]
+    for index, deps in enumerate(graph):
+        for dep in deps:
+            dependents[dep].append(index)
+    ready = [index for index, deps in enumerate(waiting) if not deps]
+    heapq.heapify(ready)
+    done = queue.Queue()
+
+    def worker(index):
+        try:
+            run_item(items[index])
+            done.put((index, None))
+        except BaseException as err:
+            # Re-raised on the main thread once the other items are done
+            done.put((index, err))
+
+    running = 0
+    failure = None
+    while ready or running:
+        while ready and running < max_workers and failure is None:
+            index = heapq.heappop(ready)
+            thread = threading.Thread(target=worker, args=(index,))
+            thread.daemon = True
+            thread.start()
+            running += 1
+        if not running:
+            break
+        index, err = done.get()
+        running -= 1
+        if err is not None:
+            # Let the items already in flight finish before giving up
+            failure = failure or err
+            continue
+        for dependent in dependents[index]:
+            waiting[dependent].discard(index)
+            if not waiting[dependent]:
+                heapq.heappush(ready, dependent)
+    if failure is not None:
+        raise failure
+
+
+def process_item(item, stage, opts, prefetcher):
+    """Downloads, installs or runs one bootstrap.json item"""
+    global userid
+    # Set the filepath, name and type.
+    try:
+        path = item["file"]
+        name = item["name"]
+        type = item["type"]
+    except KeyError as e:
+        iaslog("Invalid item %s: %s" % (repr(item), str(e)))
+        return
+    iaslog("%s processing %s %s at %s" % (stage, type, name, path))
+    # On userland stage, we want to wait until we are actually
+    # in the user's session.
+    if stage == "userland":
+        while (
+            getconsoleuser()[0] is None
+            or getconsoleuser()[0] == "loginwindow"
+            or getconsoleuser()[0] == "_mbsetupuser"
+        ):
+            iaslog(
+                "Detected SetupAssistant in userland "
+                "stage - delaying install until user "
+                "session."
+            )
+            time.sleep(1)
+
+    # Start item runtime timer
+    item_runtime_start = time.time()
+
+    # Pick up any change to the rate limit before downloading more
+    reload_throttle_config()
+
+    # Queue up the next downloads and wait on this one if needed
+    prefetcher.advance(item)
+
+    if type == "package":
+        packageid = item["packageid"]
+        version = item["version"]
+        try:
+            pkg_required = item["required"]
+        except KeyError:
+            pkg_required = False
+        try:
+            skip_if = item["skip_if"]
+        except KeyError:
+            skip_if = False
+        # Compare version of package with installed version and ensure
+        # pkg is not a required install
+        if not pkg_required and receipt_installed(packageid, version):
+            iaslog("Skipping %s - already installed." % name)
+        # Skip if a declared criteria is met
+        elif skip_if and validate_skip_if(skip_if):
+            iaslog(
+                "Skipping %s - passes skip_if criteria: %s" % (name, skip_if)
+            )
+        else:
+            # Download the package if it isn't already on disk.
+            download_if_needed(item, stage, type, opts)
+
+            iaslog("Installing %s from %s" % (name, path))
+            middleware_hook("pre_install", item)
+            # Install the package. installer only handles one at a time.
+            with g_install_lock:
+                installpackage(
+                    item["file"],
+                    lambda percent, phase: middleware_hook(
+                        "install_progress", item, percent, phase
+                    ),
+                    item.get("timeout"),
+                    name,
+                )
+                if g_receipts is not None:
+                    g_receipts.refresh(packageid)
+    elif type == "rootscript":
+        if "url" in item:
+            download_if_needed(item, stage, type, opts)
+        iaslog("Starting root script: %s" % path)
+        middleware_hook("pre_install", item)
+        try:
+            donotwait = item["donotwait"]
+        except KeyError as e:
+            donotwait = False
+        if stage == "preflight":
+            preflightrun = runrootscript(
+                path, donotwait, item.get("timeout"), name
+            )
+            if preflightrun:
+                iaslog("Preflight passed all checks. Skipping run.")
+                userid = str(getconsoleuser()[1])
+                cleanup(0)
+            else:
+                iaslog("Preflight did not pass all checks. " "Continuing run.")
+                return
+
+        runrootscript(path, donotwait, item.get("timeout"), name)
+    elif type == "userscript":
+        if "url" in item:
+            download_if_needed(item, stage, type, opts)
+        if stage == "setupassistant":
+            iaslog(
+                "Detected setupassistant and user script. "
+                "User scripts cannot work in setupassistant stage! "
+                "Removing %s" % path
+            )
+            os.remove(path)
+            return
+        middleware_hook("pre_install", item)
+        # There is only one LaunchAgent to run user scripts
+        with g_install_lock:
+            g_userscripts.run(path, item.get("timeout"))
+
+    # Log item runtime
+    write_item_total_runtime(stage, name, item_runtime_start)
 
 
 def main():
     # Options
     usage = "%prog [options]"
     o = optparse.OptionParser(usage=usage)
-    o.add_option("--jsonurl", default=None, help=("Required: URL to json file."))
+    o.add_option(
+        "--jsonurl",
+        default=None,
+        action="append",
+        help=("Required: URL to json file. Can be specified multiple times "
+              "to list mirrors."),
+    )
     o.add_option(
         "--dry-run",
         default=False,
@@ -578,6 +2503,207 @@ def main():
         action="store_true",
     )
     o.add_option("--headers", default=None, help=("Optional: Auth headers"))
+    o.add_option(
+        "--bootstrap-timeout",
+        default=60,
+        type="int",
+        help=("Optional: Seconds to keep trying to download bootstrap.json "
+              "before falling back to the last copy that was downloaded. "
+              "Defaults to 60."),
+    )
+    o.add_option(
+        "--network-timeout",
+        default=300,
+        type="int",
+        help=("Optional: Seconds to wait for the bootstrap.json host to be "
+              "reachable before starting anyway. Defaults to 300."),
+    )
+    o.add_option(
+        "--skip-network-check",
+        default=False,
+        action="store_true",
+        help=("Optional: Don't wait for the bootstrap.json host to be "
+              "reachable before downloading it."),
+    )
+    o.add_option(
+        "--start-jitter",
+        default=0,
+        type="float",
+        help=("Optional: Wait a random time of up to this many seconds before "
+              "downloading bootstrap.json, to spread out a fleet that starts "
+              "at the same time. Defaults to 0."),
+    )
+    o.add_option(
+        "--seed-dir",
+        default=[],
+        action="append",
+        help=("Optional: Directory to look for payloads in, by hash, before "
+              "downloading them. Can be specified multiple times."),
+    )
+    o.add_option(
+        "--receipts-path",
+        default=[],
+        action="append",
+        help=("Optional: Directory of package receipts to check installed "
+              "versions against. Can be specified multiple times. Defaults "
+              "to /var/db/receipts and /Library/Apple/System/Library/Receipts."),
+    )
+    o.add_option(
+        "--mirror-probe-timeout",
+        default=2,
+        type="float",
+        help=("Optional: Seconds to wait for a mirror to accept a connection "
+              "when ranking mirrors. Defaults to 2."),
+    )
+    o.add_option(
+        "--rate-limit",
+        default=0,
+        type="int",
+        help=("Optional: Limit the combined speed of all downloads to this "
+              "many KB/s. Defaults to 0 (unlimited)."),
+    )
+    o.add_option(
+        "--throttle-config",
+        default=None,
+        help=("Optional: Path to a plist with a rate_limit key (KB/s) that is "
+              "re-read between items to change --rate-limit during a run."),
+    )
+    o.add_option(
+        "--max-retry-after",
+        default=900,
+        type="int",
+        help=("Optional: Longest time in seconds to honor a Retry-After "
+              "header from a 429 or 503 response. Defaults to 900."),
+    )
+    o.add_option(
+        "--retry-base",
+        default=5,
+        type="float",
+        help=("Optional: Seconds to back off after the first failed download. "
+              "Items can override this with retrywait. Defaults to 5."),
+    )
+    o.add_option(
+        "--retry-factor",
+        default=2,
+        type="float",
+        help=("Optional: Multiplier for the backoff after each further failed "
+              "download. Defaults to 2."),
+    )
+    o.add_option(
+        "--retry-cap",
+        default=300,
+        type="float",
+        help=("Optional: Longest backoff between download attempts, in "
+              "seconds. Defaults to 300."),
+    )
+    o.add_option(
+        "--retry-max-attempts",
+        default=4,
+        type="int",
+        help=("Optional: Download attempts per item before giving up. Items "
+              "can override this with retries. Defaults to 4."),
+    )
+    o.add_option(
+        "--retry-no-jitter",
+        default=False,
+        action="store_true",
+        help=("Optional: Wait the full backoff between download attempts "
+              "instead of a random time up to it."),
+    )
+    o.add_option(
+        "--retry-fatal",
+        default=[],
+        action="append",
+        choices=RetryPolicy.ERROR_CLASSES,
+        help=("Optional: Failure class that is not retried. Can be specified "
+              "multiple times. One of: %s." % ", ".join(RetryPolicy.ERROR_CLASSES)),
+    )
+    o.add_option(
+        "--middleware-ttl",
+        default=0,
+        type="int",
+        help=("Optional: Seconds to reuse the request options middleware "
+              "returns for a URL, unless it returns its own expiry. "
+              "Defaults to 0 (only cache when the middleware says so)."),
+    )
+    o.add_option(
+        "--write-buffer",
+        default=1024,
+        type="int",
+        help=("Optional: KB of downloaded data to collect before writing it "
+              "to disk. Defaults to 1024."),
+    )
+    o.add_option(
+        "--sync-interval",
+        default=64,
+        type="int",
+        help=("Optional: MB written between fsyncs of a download in "
+              "progress. 0 only syncs when the file is closed by the OS. "
+              "Defaults to 64."),
+    )
+    o.add_option(
+        "--store-path",
+        default="/Library/Caches/installapplications",
+        help=("Optional: Directory for the package store. Defaults to "
+              "/Library/Caches/installapplications."),
+    )
+    o.add_option(
+        "--store-size",
+        default=0,
+        type="int",
+        help=("Optional: Megabytes of verified payloads to keep in the "
+              "package store across runs. Defaults to 0 (disabled)."),
+    )
+    o.add_option(
+        "--transport",
+        default="gurl",
+        choices=["gurl", "pool"],
+        help=("Optional: Download backend. 'gurl' uses NSURLSession, 'pool' "
+              "reuses keep-alive connections across downloads. Defaults to "
+              "gurl."),
+    )
+    o.add_option(
+        "--segments",
+        default=1,
+        type="int",
+        help=("Optional: Number of concurrent byte ranges to download large "
+              "items in. Can be overridden per item. Defaults to 1 "
+              "(disabled)."),
+    )
+    o.add_option(
+        "--max-segments",
+        default=8,
+        type="int",
+        help=("Optional: Upper limit on segments for any item. Defaults to 8."),
+    )
+    o.add_option(
+        "--segment-min-size",
+        default=100,
+        type="int",
+        help=("Optional: Items smaller than this many megabytes are never "
+              "segmented. Defaults to 100."),
+    )
+    o.add_option(
+        "--prefetch-depth",
+        default=0,
+        type="int",
+        help=("Optional: Number of upcoming items to download while the "
+              "current item installs. Defaults to 0 (disabled)."),
+    )
+    o.add_option(
+        "--prefetch-host-concurrency",
+        default=2,
+        type="int",
+        help=("Optional: Maximum prefetch downloads in flight per host. "
+              "Defaults to 2."),
+    )
+    o.add_option(
+        "--max-workers",
+        default=4,
+        type="int",
+        help=("Optional: Number of items to install or run at once in stages "
+              "that use depends_on or group. Defaults to 4."),
+    )
     o.add_option(
         "--iapath",
         default="/Library/installapplications",
@@ -619,6 +2745,45 @@ def main():
         global g_dry_run
         g_dry_run = True
 
+    global g_transport
+    g_transport = opts.transport
+
+    global g_retry_policy
+    g_retry_policy = RetryPolicy(
+        base=opts.retry_base,
+        factor=opts.retry_factor,
+        cap=opts.retry_cap,
+        jitter=not opts.retry_no_jitter,
+        max_attempts=opts.retry_max_attempts,
+        fatal=opts.retry_fatal,
+    )
+    global g_max_retry_after
+    g_max_retry_after = opts.max_retry_after
+
+    global g_rate_limiter, g_rate_limit, g_throttle_config
+    g_rate_limit = opts.rate_limit
+    g_throttle_config = opts.throttle_config
+    g_rate_limiter = downloadutils.TokenBucket(g_rate_limit * 1024)
+    reload_throttle_config()
+
+    global g_mirror_ranker
+    g_mirror_ranker = MirrorRanker(opts.mirror_probe_timeout)
+
+    global g_seed_index
+    seed_dirs = [path for path in opts.seed_dir if os.path.isdir(path)]
+    for path in set(opts.seed_dir) - set(seed_dirs):
+        iaslog("Seed directory %s is not available" % path)
+    if seed_dirs:
+        g_seed_index = SeedIndex(seed_dirs)
+
+    global g_supervisor
+    g_supervisor = ProcessSupervisor()
+
+    global g_receipts
+    g_receipts = ReceiptIndex(
+        DirectoryReceiptSource(opts.receipts_path or RECEIPTS_PATHS)
+    )
+
     # Check for root and json url.
     if opts.jsonurl:
         jsonurl = opts.jsonurl
@@ -664,15 +2829,38 @@ def main():
     global ias_item_runtimes_plist
     ias_item_runtimes_plist = os.path.join(ialogpath, 'ia_item_runtimes.plist')
 
+    # Hashes of payloads verified on previous runs
+    global g_hash_cache
+    g_hash_cache = HashCache(os.path.join(iapath, "hashcache.plist"))
+
+    if not opts.userscript:
+        # Load middleware once for the whole run
+        global g_middleware
+        ia_dir = os.path.realpath(os.path.dirname(sys.argv[0]))
+        g_middleware = MiddlewareRegistry(ia_dir, opts.middleware_ttl)
+
+        # Verified payloads kept across items and runs
+        if opts.store_size:
+            global g_package_store
+            g_package_store = PackageStore(
+                opts.store_path, opts.store_size * 1024 * 1024
+            )
+
     # hardcoded json fileurl path
     jsonpath = os.path.join(iapath, "bootstrap.json")
     iaslog("InstallApplications json path: %s" % jsonpath)
 
     # User script touch path
     userscripttouchpath = "/var/tmp/installapplications/.userscript"
+    userscriptsockpath = "/var/tmp/installapplications/.userscript.sock"
 
     if opts.userscript:
         iaslog("Running in userscript mode")
+        if serve_userscripts(
+            userscriptsockpath, userscripttouchpath, iauserscriptpath
+        ):
+            sys.exit(0)
+        iaslog("Falling back to running user scripts from %s" % iauserscriptpath)
         uscript = runuserscript(iauserscriptpath)
         if uscript:
             os.remove(userscripttouchpath)
@@ -699,7 +2887,14 @@ def main():
     except Exception:
         pass
 
+    # Channel to the LaunchAgent that runs user scripts
+    global g_userscripts
+    g_userscripts = UserScriptChannel(userscriptsockpath, userscripttouchpath)
+    g_userscripts.listen()
+
     # json data for gurl download
+    if len(jsonurl) == 1:
+        jsonurl = jsonurl[0]
     json_data = {"url": jsonurl, "file": jsonpath, "name": "Bootstrap.json"}
 
     # Grab auth headers if they exist and update the json_data dict.
@@ -711,17 +2906,19 @@ def main():
     if opts.follow_redirects:
         json_data.update({"follow_redirects": True})
 
-    # Delete the bootstrap file if it exists, to ensure it's up to date.
-    if not opts.skip_validation:
-        if os.path.isfile(jsonpath):
-            iaslog("Removing and redownloading bootstrap.json")
-            os.remove(jsonpath)
-
-    # If the file doesn't exist, grab it and wait half a second to save.
-    while not os.path.isfile(jsonpath):
-        iaslog("Starting download: %s" % urllib.parse.unquote(json_data["url"]))
-        downloadfile(json_data)
-        time.sleep(0.5)
+    # Make sure bootstrap.json is up to date, unless validation is skipped
+    # and we already have a copy.
+    if not (opts.skip_validation and os.path.isfile(jsonpath)):
+        if not opts.skip_network_check:
+            ias_item_runtimes_dict["network_wait"] = round(
+                wait_for_network(json_data["url"], opts.network_timeout), 2
+            )
+        if opts.start_jitter > 0:
+            delay = random.uniform(0, opts.start_jitter)
+            iaslog("Waiting %.1f seconds before downloading bootstrap.json"
+                   % delay)
+            time.sleep(delay)
+        fetch_bootstrap(json_data, opts.bootstrap_timeout)
 
     # Load up file to grab all the items.
     iajson = json.loads(open(jsonpath).read())
@@ -729,6 +2926,31 @@ def main():
     # Set the stages
     stages = ["preflight", "setupassistant", "userland"]
 
+    # Check depends_on references and cycles before touching anything
+    try:
+        graphs = stage_graphs(iajson, stages)
+    except ValueError as err:
+        iaslog("Invalid bootstrap.json dependencies: %s" % err)
+        cleanup(1)
+
+    # Look up every package in one pass over the receipts
+    installed = g_receipts.versions(
+        set(item["packageid"] for stage in stages for item in iajson.get(stage, [])
+            if item.get("type") == "package" and "packageid" in item)
+    )
+    for packageid, version in sorted(installed.items()):
+        if version != NOT_INSTALLED:
+            iaslog("Found receipt for %s %s" % (packageid, version))
+
+    # Downloads ahead of the install cursor. Preflight is left out since a
+    # passing preflight script ends the run.
+    prefetcher = Prefetcher(
+        iajson.get("setupassistant", []) + iajson.get("userland", []),
+        opts.prefetch_depth,
+        opts.prefetch_host_concurrency,
+        opts,
+    )
+
     # Process all stages
     for stage in stages:
         if stage not in ias_item_runtimes_dict.keys():
@@ -741,113 +2963,17 @@ def main():
             except KeyError:
                 iaslog("No preflight stage found: skipping.")
                 continue
-        # Loop through the items and download/install/run them.
-        for item in iajson[stage]:
-            # Set the filepath, name and type.
-            try:
-                path = item["file"]
-                name = item["name"]
-                type = item["type"]
-            except KeyError as e:
-                iaslog("Invalid item %s: %s" % (repr(item), str(e)))
-                continue
-            # Set number or retries, and wait interval between retries
-            try:
-                retries = item["retries"]
-            except KeyError as e:
-                retries = 3
-            try:
-                retrywait = item["retrywait"]
-            except KeyError as e:
-                retrywait = 5
-            iaslog("%s processing %s %s at %s" % (stage, type, name, path))
-            # On userland stage, we want to wait until we are actually
-            # in the user's session.
-            if stage == "userland":
-                if len(iajson["userland"]) > 0:
-                    while (
-                        getconsoleuser()[0] is None
-                        or getconsoleuser()[0] == "loginwindow"
-                        or getconsoleuser()[0] == "_mbsetupuser"
-                    ):
-                        iaslog(
-                            "Detected SetupAssistant in userland "
-                            "stage - delaying install until user "
-                            "session."
-                        )
-                        time.sleep(1)
-
-            # Start item runtime timer
-            item_runtime_start = time.time()
-
-            if type == "package":
-                packageid = item["packageid"]
-                version = item["version"]
-                try:
-                    pkg_required = item["required"]
-                except KeyError:
-                    pkg_required = False
-                try:
-                    skip_if = item["skip_if"]
-                except KeyError:
-                    skip_if = False
-                # Compare version of package with installed version and ensure
-                # pkg is not a required install
-                if (
-                    LooseVersion(checkreceipt(packageid)) >= LooseVersion(version)
-                    and not pkg_required
-                ):
-                    iaslog("Skipping %s - already installed." % name)
-                # Skip if a declared criteria is met
-                elif skip_if and validate_skip_if(skip_if):
-                    iaslog(
-                        "Skipping %s - passes skip_if criteria: %s" % (name, skip_if)
-                    )
-                else:
-                    # Download the package if it isn't already on disk.
-                    download_if_needed(item, stage, type, retries, retrywait, opts)
-
-                    iaslog("Installing %s from %s" % (name, path))
-                    # Install the package
-                    installpackage(item["file"])
-            elif type == "rootscript":
-                if "url" in item:
-                    download_if_needed(item, stage, type, retries, retrywait, opts)
-                iaslog("Starting root script: %s" % path)
-                try:
-                    donotwait = item["donotwait"]
-                except KeyError as e:
-                    donotwait = False
-                if stage == "preflight":
-                    preflightrun = runrootscript(path, donotwait)
-                    if preflightrun:
-                        iaslog("Preflight passed all checks. Skipping run.")
-                        userid = str(getconsoleuser()[1])
-                        cleanup(0)
-                    else:
-                        iaslog("Preflight did not pass all checks. " "Continuing run.")
-                        continue
-
-                runrootscript(path, donotwait)
-            elif type == "userscript":
-                if "url" in item:
-                    download_if_needed(item, stage, type, retries, retrywait, opts)
-                if stage == "setupassistant":
-                    iaslog(
-                        "Detected setupassistant and user script. "
-                        "User scripts cannot work in setupassistant stage! "
-                        "Removing %s" % path
-                    )
-                    os.remove(path)
-                    continue
-                iaslog("Triggering LaunchAgent for user script: %s" % path)
-                touch(userscripttouchpath)
-                while os.path.isfile(userscripttouchpath):
-                    iaslog("Waiting for user script to complete: %s" % path)
-                    time.sleep(0.5)
-
-            # Log item runtime
-            write_item_total_runtime(stage, name, item_runtime_start)
+        # Download/install/run the items, in order unless they say otherwise
+        try:
+            run_stage(
+                stage,
+                iajson[stage],
+                graphs[stage],
+                opts.max_workers,
+                lambda item: process_item(item, stage, opts, prefetcher),
+            )
+        except ItemFailed:
+            cleanup(1)
     # Cleanup and send good exit status
     cleanup(0)
 
@@ -0,0 +1,605 @@
+# encoding: utf-8
+#
+# Copyright 2017-Present Erik Gomez.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+poolurl.py
+
+Download backend built only on the standard library. It takes the same
+options dict and exposes the same attributes as gurl.Gurl, so
+installapplications can use either one, but keeps HTTP connections alive in
+a pool shared by every download so a bootstrap of many items pays for the
+TCP and TLS handshakes once per host instead of once per file.
+
+Because it doesn't need PyObjC it also runs on other platforms, which is
+handy for testing and benchmarking the download path:
+
+    python3 poolurl.py URL DESTINATION [URL DESTINATION ...]
+"""
+from __future__ import absolute_import, print_function
+
+import base64
+import gzip
+import hashlib
+import http.client
+import os
+import shutil
+import ssl
+import sys
+import threading
+import time
+from urllib.parse import urljoin, urlparse
+from urllib.request import url2pathname
+
+import downloadutils
+
+try:
+    import certifi
+except ImportError:
+    certifi = None
+
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+CHUNK_SIZE = 2 ** 16
+# bodies left over from redirects and the like are read off the connection
+# so it can be reused only when they are at most this big
+DRAIN_LIMIT = 2 ** 16
+# Same value as NSURLResponseUnknownLength
+UNKNOWN_LENGTH = -1
+
+
+class PoolUrlError(object):
+    '''Error details for a failed transfer. Provides the same accessors as
+    the NSError gurl records, so callers can log either one.'''
+
+    def __init__(self, code, description):
+        self._code = code
+        self._description = description
+
+    def code(self):
+        '''Error code'''
+        return self._code
+
+    def localizedDescription(self):
+        '''Error description'''
+        return self._description
+
+
+class ConnectionPool(object):
+    '''Idle keep-alive HTTP connections, keyed by scheme, host and port'''
+
+    def __init__(self, max_idle_per_host=4):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.ssl_context = ssl.create_default_context(
+            cafile=certifi.where() if certifi else None)
+
+    def key(self, parsed_url):
+        '''Returns the pool key for a parsed URL'''
+        port = parsed_url.port or (443 if parsed_url.scheme == 'https' else 80)
+        return (parsed_url.scheme, parsed_url.hostname, port)
+
+    def get(self, key, timeout):
+        '''Returns (connection, reused) for key'''
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                connection = connections.pop()
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+        return self.connect(key, timeout), False
+
+    def connect(self, key, timeout):
+        '''Returns a new connection for key'''
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(
+                host, port, timeout=timeout, context=self.ssl_context)
+        return http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def put(self, key, connection):
+        '''Returns a connection to the pool for reuse'''
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        '''Closes every idle connection'''
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+
+
+# shared by every PoolUrl so connections are reused across downloads
+default_pool = ConnectionPool()
+
+
+def _print_log(message):
+    '''Default logging function'''
+    print(message)
+
+
+class PoolUrl(object):
+    '''Downloads a URL to a file on a background thread using a pooled
+    http.client connection'''
+
+    def __init__(self, options, pool=None):
+        self.follow_redirects = options.get('follow_redirects', False)
+        self.destination_path = options.get('file')
+        self.can_resume = options.get('can_resume', False)
+        self.byte_range = options.get('byte_range')
+        self.url = options.get('url')
+        self.additional_headers = options.get('additional_headers', {})
+        self.username = options.get('username')
+        self.password = options.get('password')
+        self.download_only_if_changed = options.get(
+            'download_only_if_changed', False)
+        self.cache_data = options.get('cache_data')
+        self.connection_timeout = options.get('connection_timeout', 60)
+        self.hash_algorithm = options.get('hash_algorithm', 'sha256')
+        self.rate_limiters = options.get('rate_limiters', [])
+        self.decompress = options.get('decompress', False)
+        # size of the complete file, from the manifest
+        self.expected_size = options.get('expected_size')
+        self.write_buffer_size = options.get('write_buffer_size', 2 ** 20)
+        self.sync_interval = options.get('sync_interval', 2 ** 26)
+        self.log = options.get('logging_function', _print_log)
+        self.progress = downloadutils.ProgressReporter(
+            options.get('progress_callback'),
+            options.get('progress_interval', 1.0),
+            options.get('progress_bytes', 0))
+        self.pool = pool or default_pool
+
+        self.resume = False
+        self.response = None
+        self.headers = None
+        self.status = None
+        self.error = None
+        self.SSLerror = None
+        self.done = False
+        self.cancelled = False
+        self.aborted = False
+        self.redirection = []
+        self.destination = None
+        self.bytesReceived = 0
+        self.bytesWritten = 0
+        self.writeCount = 0
+        self.writeTime = 0.0
+        self.syncCount = 0
+        self.expectedLength = UNKNOWN_LENGTH
+        self.percentComplete = 0
+        self.hash_function = None
+        self.digest = None
+        self.decoder = None
+        self.thread = None
+        self.done_event = threading.Event()
+
+    def start(self):
+        '''Start the download on a background thread'''
+        if not self.destination_path:
+            self.log('No output file specified.')
+            self.done = True
+            self.done_event.set()
+            return
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def cancel(self):
+        '''Cancel the download'''
+        self.cancelled = True
+
+    def wait(self, timeout=None):
+        '''Block until the download is complete or timeout seconds have
+        passed. Returns True if it is complete.'''
+        self.done_event.wait(timeout)
+        return self.done
+
+    def isDone(self):
+        '''Check if the download is complete, waiting briefly if it isn't'''
+        return self.wait(.1)
+
+    def getStoredHeaders(self):
+        '''Returns any stored headers for self.destination_path'''
+        return downloadutils.get_stored_headers(self.destination_path)
+
+    def storeHeaders_(self, headers):
+        '''Store download metadata for self.destination_path'''
+        if not downloadutils.store_headers(self.destination_path, headers):
+            self.log('Could not store metadata to %s' % self.destination_path)
+
+    def _run(self):
+        try:
+            self._fetch()
+        except ssl.SSLError as err:
+            self.SSLerror = (err.errno, err.reason or str(err))
+            self.error = PoolUrlError(err.errno or -1, str(err))
+        except Exception as err:
+            self.error = PoolUrlError(getattr(err, 'errno', None) or -1,
+                                      str(err))
+        finally:
+            if self.destination:
+                if (self.decoder is not None and self.error is None and
+                        not self.cancelled):
+                    self._write(self.decoder.flush())
+                self.destination.close()
+                self.writeCount = self.destination.writeCount
+                self.writeTime = self.destination.writeTime
+                self.syncCount = self.destination.syncCount
+                if self.hash_function is not None:
+                    self.digest = self.hash_function.hexdigest()
+                if self.aborted:
+                    # whatever we got isn't the file, so don't resume it
+                    os.unlink(self.destination_path)
+                    downloadutils.remove_stored_headers(self.destination_path)
+                elif self.error is None and not self.cancelled:
+                    self._removeExpectedSizeFromStoredHeaders()
+            self.done = True
+            self.done_event.set()
+
+    def _requestHeaders(self):
+        headers = {}
+        if self.username and self.password:
+            credentials = '%s:%s' % (self.username, self.password)
+            headers['Authorization'] = 'Basic %s' % base64.b64encode(
+                credentials.encode('utf-8')).decode('ascii')
+        headers.update(self.additional_headers or {})
+        if self.byte_range:
+            headers['Range'] = 'bytes=%s-%s' % tuple(self.byte_range)
+        elif os.path.isfile(self.destination_path):
+            # does the file already exist? See if we can resume
+            stored_data = self.getStoredHeaders()
+            if (self.can_resume and 'expected-length' in stored_data and
+                    ('last-modified' in stored_data or 'etag' in stored_data)):
+                self.resume = True
+                local_filesize = os.path.getsize(self.destination_path)
+                headers['Range'] = 'bytes=%s-' % local_filesize
+        if self.download_only_if_changed and not self.resume:
+            stored_data = self.cache_data or self.getStoredHeaders()
+            if 'last-modified' in stored_data:
+                headers['If-Modified-Since'] = stored_data['last-modified']
+            if 'etag' in stored_data:
+                headers['If-None-Match'] = stored_data['etag']
+        if not self.byte_range and not self.resume:
+            # only whole files are decompressed; ranges are of the raw bytes
+            headers.setdefault('Accept-Encoding', 'gzip')
+        return headers
+
+    def _allowRedirect(self, new_url):
+        if self.follow_redirects is True or self.follow_redirects == 'all':
+            return True
+        return (self.follow_redirects == 'https' and
+                urlparse(new_url).scheme == 'https')
+
+    def _request(self, url, headers):
+        '''Sends a GET for url and returns (key, connection, response)'''
+        parsed = urlparse(url)
+        key = self.pool.key(parsed)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        connection, reused = self.pool.get(key, self.connection_timeout)
+        try:
+            connection.request('GET', path, headers=headers)
+            return key, connection, connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            if not reused:
+                raise
+        # the server closed the idle connection; try again on a new one
+        connection = self.pool.connect(key, self.connection_timeout)
+        connection.request('GET', path, headers=headers)
+        return key, connection, connection.getresponse()
+
+    def _fetch(self):
+        url = self.url
+        headers = self._requestHeaders()
+        for _ in range(MAX_REDIRECTS + 1):
+            key, connection, response = self._request(url, headers)
+            location = response.getheader('Location')
+            if response.status not in REDIRECT_CODES or not location:
+                break
+            new_url = urljoin(url, location)
+            self.redirection.append([new_url, dict(response.getheaders())])
+            if not self._allowRedirect(new_url):
+                self.log('Denying redirect to: %s' % new_url)
+                break
+            self._release(key, connection, response)
+            self.log('Allowing redirect to: %s' % new_url)
+            url = new_url
+        if self._handleResponse(response):
+            # the file on the server changed since our partial download;
+            # don't read the rest of the stale body just to reuse the socket
+            connection.close()
+            self.resume = False
+            return self._fetch()
+        if self.aborted:
+            connection.close()
+            return
+        while not self.cancelled and not self.aborted:
+            data = response.read(CHUNK_SIZE)
+            if not data:
+                break
+            self._handleReceivedData(data)
+        if self.aborted:
+            connection.close()
+        elif self.cancelled:
+            connection.close()
+            self.error = PoolUrlError(-999, 'cancelled')
+        else:
+            self._release(key, connection, response)
+
+    def _release(self, key, connection, response):
+        '''Finish reading response and put the connection back in the pool
+        if the server will keep it open. Connections with more than
+        DRAIN_LIMIT bytes (or an unknown amount) left to read are closed
+        instead.'''
+        if not response.isclosed() and (
+                response.length is None or response.length > DRAIN_LIMIT):
+            connection.close()
+            return
+        try:
+            response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            return
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(key, connection)
+
+    def _handleResponse(self, response):
+        '''Handle the response headers. Returns True if the download needs
+        to start over from scratch.'''
+        self.response = response
+        self.status = response.status
+        self.headers = dict(response.getheaders())
+        self.bytesReceived = 0
+        self.percentComplete = -1
+        length = response.getheader('Content-Length')
+        self.expectedLength = int(length) if length else UNKNOWN_LENGTH
+
+        download_data = {}
+        normalized_headers = dict(
+            (key.lower(), value) for key, value in self.headers.items())
+        if 'last-modified' in normalized_headers:
+            download_data['last-modified'] = normalized_headers[
+                'last-modified']
+        if 'etag' in normalized_headers:
+            download_data['etag'] = normalized_headers['etag']
+        encoding = normalized_headers.get('content-encoding', '').lower()
+        if not encoding:
+            # a decoded body can't be resumed from a byte offset
+            download_data['expected-length'] = self.expectedLength
+
+        mismatch = downloadutils.size_mismatch(
+            self.expected_size, self.status, normalized_headers,
+            self.decompress)
+        if mismatch:
+            self._abort(mismatch)
+            return False
+
+        if self.status == 206 and self.byte_range:
+            if not os.path.exists(self.destination_path):
+                open(self.destination_path, 'wb').close()
+            fileref = open(self.destination_path, 'r+b')
+            fileref.seek(self.byte_range[0])
+            self._openDestination(fileref, 0)
+
+        elif self.status == 206 and self.resume:
+            stored_data = self.getStoredHeaders()
+            if (not stored_data or
+                    stored_data.get('etag') != download_data.get('etag') or
+                    stored_data.get('last-modified') != download_data.get(
+                        'last-modified')):
+                self.log('Can\'t resume download; file on server has changed.')
+                self.log('Restarting download of %s' % self.destination_path)
+                os.unlink(self.destination_path)
+                return True
+            self.log('Resuming download for %s' % self.destination_path)
+            local_filesize = os.path.getsize(self.destination_path)
+            self.bytesReceived = local_filesize
+            self.bytesWritten = local_filesize
+            if self.expectedLength != UNKNOWN_LENGTH:
+                self.expectedLength += local_filesize
+            self._startDigest(self.destination_path)
+            self._openDestination(open(self.destination_path, 'ab'),
+                                  self._fileSize() - local_filesize)
+
+        elif self.status == 416 and self.resume:
+            self.log('Can\'t resume download; removing %s'
+                     % self.destination_path)
+            os.unlink(self.destination_path)
+            downloadutils.remove_stored_headers(self.destination_path)
+
+        elif str(self.status).startswith('2'):
+            fileref = open(self.destination_path, 'wb')
+            self._startDigest(None)
+            if encoding in ('gzip', 'x-gzip') or self.decompress:
+                self.decoder = downloadutils.GzipDecoder()
+            self._openDestination(fileref, self._fileSize())
+            self.storeHeaders_(download_data)
+        return False
+
+    def _openDestination(self, fileref, size):
+        '''Wrap fileref so received data is written in large blocks'''
+        self.destination = downloadutils.DestinationWriter(
+            fileref, self.write_buffer_size, self.sync_interval, size)
+
+    def _fileSize(self):
+        '''The size the destination will end up, if it is known'''
+        if self.expected_size:
+            return self.expected_size
+        if self.decoder is None and self.expectedLength != UNKNOWN_LENGTH:
+            return self.expectedLength
+        return 0
+
+    def _abort(self, message):
+        '''Stop the transfer because the server isn't sending the file'''
+        self.log(message)
+        self.error = PoolUrlError(downloadutils.SIZE_MISMATCH_ERROR, message)
+        self.aborted = True
+
+    def _startDigest(self, seed_path):
+        if not self.hash_algorithm:
+            return
+        self.hash_function = hashlib.new(self.hash_algorithm)
+        if seed_path:
+            with open(seed_path, 'rb') as fileref:
+                while True:
+                    chunk = fileref.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.hash_function.update(chunk)
+
+    def _removeExpectedSizeFromStoredHeaders(self):
+        if str(self.status).startswith('2') and not self.byte_range:
+            headers = self.getStoredHeaders()
+            if 'expected-length' in headers:
+                del headers['expected-length']
+                self.storeHeaders_(headers)
+
+    def _write(self, data):
+        self.destination.write(data)
+        self.bytesWritten += len(data)
+        if self.hash_function is not None:
+            self.hash_function.update(data)
+
+    def _handleReceivedData(self, data):
+        for limiter in self.rate_limiters:
+            limiter.consume(len(data))
+        if self.destination:
+            if self.decoder is not None:
+                self._write(self.decoder.decode(data))
+            else:
+                self._write(data)
+        if (self.expected_size and not self.byte_range and
+                self.bytesWritten > self.expected_size):
+            self._abort('Received more than the expected %s bytes'
+                        % self.expected_size)
+        # progress is measured in bytes on the wire, like Content-Length
+        self.bytesReceived += len(data)
+        if self.expectedLength != UNKNOWN_LENGTH and self.expectedLength:
+            self.percentComplete = int(
+                float(self.bytesReceived) / float(self.expectedLength) * 100.0)
+        self.progress.update(self)
+
+
+class FileUrl(object):
+    '''Copies a file:// URL to its destination, with the same interface as
+    PoolUrl. The copy is an APFS clone where possible (or decompressed, for
+    the decompress option), so digest is left unset and the caller hashes
+    the result.'''
+
+    def __init__(self, options):
+        self.url = options.get('url')
+        self.destination_path = options.get('file')
+        self.decompress = options.get('decompress', False)
+        self.log = options.get('logging_function', _print_log)
+
+        self.response = None
+        self.headers = {}
+        self.status = None
+        self.error = None
+        self.SSLerror = None
+        self.done = False
+        self.redirection = []
+        self.bytesReceived = 0
+        self.bytesWritten = 0
+        self.writeCount = 0
+        self.writeTime = 0.0
+        self.syncCount = 0
+        self.expectedLength = UNKNOWN_LENGTH
+        self.percentComplete = 0
+        self.digest = None
+        self.thread = None
+        self.done_event = threading.Event()
+
+    def start(self):
+        '''Start the copy on a background thread'''
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def cancel(self):
+        '''A copy can't be interrupted part way; it finishes on its own'''
+        pass
+
+    def wait(self, timeout=None):
+        '''Blocks until the copy is done. Returns True if it finished'''
+        return self.done_event.wait(timeout)
+
+    def isDone(self):
+        '''Check if the copy is done'''
+        return self.done
+
+    def _run(self):
+        source = url2pathname(urlparse(self.url).path)
+        try:
+            self.expectedLength = os.path.getsize(source)
+            if self.decompress:
+                with gzip.open(source, 'rb') as fileref:
+                    with open(self.destination_path, 'wb') as destination:
+                        shutil.copyfileobj(fileref, destination)
+            else:
+                downloadutils.clone_file(source, self.destination_path)
+        except (OSError, IOError, EOFError) as err:
+            self.error = PoolUrlError(err.errno or -1, str(err))
+        else:
+            self.status = 200
+            self.bytesReceived = self.expectedLength
+            self.percentComplete = 100
+        finally:
+            self.done = True
+            self.done_event.set()
+
+
+def main():
+    '''Downloads each URL/destination pair in turn and reports timings'''
+    args = sys.argv[1:]
+    if not args or len(args) % 2:
+        print('Usage: %s URL DESTINATION [URL DESTINATION ...]' % sys.argv[0])
+        return 1
+    started = time.time()
+    exit_code = 0
+    for url, destination in zip(args[::2], args[1::2]):
+        item_started = time.time()
+        connection = PoolUrl({'url': url, 'file': destination,
+                              'follow_redirects': True})
+        connection.start()
+        connection.wait()
+        elapsed = time.time() - item_started
+        if connection.error is not None:
+            exit_code = 1
+            print('%s: error %s %s' % (url, connection.error.code(),
+                                       connection.error.localizedDescription()))
+            continue
+        print('%s: status %s, %s bytes in %.3fs, sha256 %s'
+              % (url, connection.status, connection.bytesReceived, elapsed,
+                 connection.digest))
+    print('Total: %.3fs' % (time.time() - started))
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())